@@ -0,0 +1,5 @@
+"""
+Benchmarks for halpy, run against a fake HAL driver. Usage:
+
+    python -m benchmarks [--output results.json] [scenario ...]
+"""
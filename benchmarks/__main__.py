@@ -0,0 +1,76 @@
+"""Run the benchmark scenarios, and output the results as JSON"""
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from halpy import HAL
+from .fakedriver import FakeDriver
+from .scenarios import SCENARIOS
+
+
+def run_scenario(name, root, quick=False):
+    """Run a scenario against a new fake driver, return its results"""
+    scenario, hal_options, quick_params = SCENARIOS[name]
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    driver = loop.run_until_complete(FakeDriver(root, loop=loop).start())
+    hal = HAL(root, **hal_options)
+    try:
+        hal.install_loop(loop)
+        loop.run_until_complete(driver.wait_clients())
+        params = quick_params if quick else {}
+        results = loop.run_until_complete(scenario(driver, hal, **params))
+    finally:
+        hal.close()
+        driver.stop()
+        loop.close()
+    return {
+        'scenario': name,
+        'hal_options': hal_options,
+        'results': results,
+    }
+
+
+def run(names, root, quick=False):
+    """Run the given scenarios, return a JSON-serializable report"""
+    return {
+        'timestamp': time.time(),
+        'python': sys.version,
+        'quick': quick,
+        'scenarios': [run_scenario(name, root, quick) for name in names],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks', description=__doc__)
+    parser.add_argument(
+        'scenarios', nargs='*', metavar='scenario',
+        help="Scenarios to run, among: " + ', '.join(sorted(SCENARIOS)))
+    parser.add_argument(
+        '-o', '--output', help="Write the JSON report to this file")
+    parser.add_argument(
+        '--root', default='/tmp/halpy-benchmark',
+        help="Where to create the fake driver tree")
+    parser.add_argument(
+        '--quick', action='store_true', help="Small runs (smoke test)")
+    args = parser.parse_args(argv)
+
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error("Unknown scenario " + name)
+    report = run(args.scenarios or sorted(SCENARIOS), args.root, args.quick)
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""A stand-in for the HAL driver: a halfs tree and its events socket"""
+
+import asyncio
+import os
+from os import path
+from shutil import rmtree
+
+
+class FakeDriver(object):
+    """
+    Create a halfs tree under root, with n resources of each type, and serve
+    the events socket. Writes to the tree are regular file writes, hence
+    fire inotify events like writes to the real driver.
+    """
+
+    def __init__(self, root, n=4, loop=None):
+        self.root = root
+        self.n = n
+        self.loop = loop or asyncio.get_event_loop()
+        self.clients = []
+        self.server = None
+        self.sent_events = 0
+
+    def names(self, hal_type):
+        return ['{}{}'.format(hal_type[:-1], i) for i in range(self.n)]
+
+    def create_tree(self):
+        """Create the files of the fake driver"""
+        if path.exists(self.root):
+            rmtree(self.root)
+        os.makedirs(path.join(self.root, 'driver'))
+        for name, value in (('rx_bytes', '0'), ('tx_bytes', '0'),
+                            ('uptime', '0'), ('loglevel', '0')):
+            self.write(value, 'driver', name)
+        for hal_type, value in (('switchs', '0'), ('triggers', '0'),
+                                ('sensors', '0.5'), ('rgbs', '#000000')):
+            os.mkdir(path.join(self.root, hal_type))
+            for name in self.names(hal_type):
+                self.write(value, hal_type, name)
+        os.mkdir(path.join(self.root, 'animations'))
+        for name in self.names('animations'):
+            os.mkdir(path.join(self.root, 'animations', name))
+            for filename, value in (('play', '0'), ('loop', '0'),
+                                    ('fps', '25'), ('frames', '')):
+                self.write(value, 'animations', name, filename)
+
+    def write(self, value, *filepath):
+        """Write a file of the fake driver tree"""
+        with open(path.join(self.root, *filepath), 'w') as f:
+            f.write(value)
+
+    @asyncio.coroutine
+    def start(self):
+        """Create the tree and start serving the events socket"""
+        self.create_tree()
+        self.server = yield from asyncio.start_unix_server(
+            self.client_connected, path.join(self.root, 'events'),
+            loop=self.loop)
+        return self
+
+    def client_connected(self, reader, writer):
+        self.clients.append(writer)
+
+    @asyncio.coroutine
+    def wait_clients(self, n=1):
+        """Coroutine returning when n clients are connected"""
+        while len(self.clients) < n:
+            yield from asyncio.sleep(0.001, loop=self.loop)
+
+    def send_events(self, events):
+        """Send a list of (trigger_name, state) events to all clients"""
+        data = ''.join(
+            '{}:{}\n'.format(name, int(state)) for name, state in events)
+        for writer in self.clients:
+            writer.write(data.encode())
+        self.sent_events += len(events)
+
+    @asyncio.coroutine
+    def emit(self, count, rate=None, tick=0.005):
+        """
+        Send count trigger events, cycling over all triggers, at the given
+        rate (in events per second), or as fast as possible if None
+        """
+        names = self.names('triggers')
+        events = [
+            (names[i % len(names)], (i // len(names)) % 2 == 0)
+            for i in range(count)]
+        if rate is None:
+            self.send_events(events)
+            return
+        start = self.loop.time()
+        sent = 0
+        while sent < count:
+            due = min(count, int((self.loop.time() - start) * rate) + 1)
+            self.send_events(events[sent:due])
+            sent = due
+            yield from asyncio.sleep(tick, loop=self.loop)
+
+    def stop(self):
+        """Close the events socket and remove the tree"""
+        for writer in self.clients:
+            writer.close()
+        if self.server is not None:
+            self.server.close()
+        rmtree(self.root, ignore_errors=True)
@@ -0,0 +1,118 @@
+"""
+Benchmark scenarios. Each scenario is a coroutine taking the fake driver,
+a HAL object on its tree and the scenario parameters, and returning a dict
+of measurements.
+"""
+
+import asyncio
+import time
+
+
+def percentile(values, p):
+    """Return the p-th percentile (0 <= p <= 100) of a list of values"""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+@asyncio.coroutine
+def trigger_dispatch(driver, hal, count=20000, handlers=4, rate=None):
+    """Throughput of trigger events, from the events socket to handlers"""
+    loop = hal.loop
+    done = asyncio.Future(loop=loop)
+    expected = count * handlers
+    received = [0]
+
+    def count_event(name, state):
+        received[0] += 1
+        if received[0] == expected:
+            done.set_result(loop.time())
+
+    for i in range(handlers):
+        hal.on_trigger()(count_event)
+
+    start = loop.time()
+    yield from driver.emit(count, rate)
+    end = yield from done
+    return {
+        'events': count,
+        'handlers': handlers,
+        'seconds': end - start,
+        'events_per_second': count / (end - start),
+    }
+
+
+@asyncio.coroutine
+def change_latency(driver, hal, samples=200):
+    """Latency from a write in the tree to the call of its change handler"""
+    loop = hal.loop
+    switch = sorted(hal.switchs)[0]
+    resource = hal.switchs[switch]
+    pending = []
+
+    @resource.on_change
+    def changed(resource):
+        if pending and not pending[0].done():
+            pending[0].set_result(loop.time())
+
+    latencies = []
+    for i in range(samples):
+        pending[:] = [asyncio.Future(loop=loop)]
+        start = loop.time()
+        driver.write(str(i % 2), 'switchs', switch)
+        latencies.append((yield from pending[0]) - start)
+    return {
+        'samples': samples,
+        'mean_ms': 1000 * sum(latencies) / samples,
+        'p50_ms': 1000 * percentile(latencies, 50),
+        'p99_ms': 1000 * percentile(latencies, 99),
+        'max_ms': 1000 * max(latencies),
+    }
+
+
+@asyncio.coroutine
+def read_write(driver, hal, ops=5000):
+    """Synchronous property reads and writes per second"""
+    switch = hal.switchs[sorted(hal.switchs)[0]]
+    sensor = hal.sensors[sorted(hal.sensors)[0]]
+
+    start = time.perf_counter()
+    for i in range(ops):
+        switch.on
+        sensor.value
+    reads = 2 * ops / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(ops):
+        switch.on = i % 2
+    writes = ops / (time.perf_counter() - start)
+    return {
+        'ops': ops,
+        'reads_per_second': reads,
+        'writes_per_second': writes,
+    }
+
+
+@asyncio.coroutine
+def animation_upload(driver, hal, uploads=2000, frames=255):
+    """Uploads of full animations per second, from a list and from bytes"""
+    anim = hal.animations[sorted(hal.animations)[0]]
+    as_list = [i % 256 for i in range(frames)]
+    as_bytes = bytes(as_list)
+    res = {'uploads': uploads, 'frames': frames}
+    for name, value in (('list', as_list), ('bytes', as_bytes)):
+        start = time.perf_counter()
+        for i in range(uploads):
+            anim.configure(frames=value, force=True)
+        res[name + '_uploads_per_second'] = \
+            uploads / (time.perf_counter() - start)
+    return res
+
+
+# name: (coroutine, HAL options, parameters for a quick run)
+SCENARIOS = {
+    'trigger_dispatch': (trigger_dispatch, {}, {'count': 200}),
+    'change_latency': (change_latency, {}, {'samples': 10}),
+    'read_write': (read_write, {}, {'ops': 50}),
+    'read_write_fd_cache': (read_write, {'fd_cache_size': 64}, {'ops': 50}),
+    'animation_upload': (animation_upload, {}, {'uploads': 20}),
+}
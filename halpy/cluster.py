@@ -0,0 +1,187 @@
+"""
+Drive several HAL devices (several halfs mounts, one per Arduino) from one
+process: all devices share the same event loop and a single inotify
+instance, whose changes are routed to the HAL object owning the file.
+
+:Example:
+
+>>> cluster = HALCluster({'front': '/hal/front', 'back': '/hal/back'})
+>>>
+>>> @cluster.on_trigger('door', True, device='front')
+>>> def front_door_opened(name, state):
+>>>     cluster['back'].switchs.bell.on = True
+>>>
+>>> cluster.run()
+"""
+
+import asyncio
+import os
+from collections import OrderedDict
+from os import path
+from .hal import HAL
+from .simple_inotify import InotifyWatch
+
+
+class HALCluster(object):
+    """
+    A set of named HAL objects. devices maps each device name to the root of
+    its halfs tree (or to a HAL object); other keyword arguments are given
+    to the HAL objects created by the cluster.
+    """
+
+    def __init__(self, devices, **hal_options):
+        self.devices = OrderedDict()
+        for name, root in sorted(devices.items()):
+            if not isinstance(root, HAL):
+                root = HAL(root, **hal_options)
+            self.devices[name] = root
+        self.loop = None
+        self.watcher = None
+
+    def __getitem__(self, device):
+        return self.devices[device]
+
+    def __iter__(self):
+        return iter(self.devices)
+
+    def __len__(self):
+        return len(self.devices)
+
+    def select(self, device=None):
+        """Return the HAL objects of the given device, or of all if None"""
+        if device is None:
+            return list(self.devices.values())
+        return [self.devices[device]]
+
+    def hal_for(self, filepath):
+        """Return the HAL object whose tree contains filepath, or None"""
+        best = None
+        for hal in self.devices.values():
+            root = path.join(hal.halfs_root, '')
+            if filepath.startswith(root) or filepath == hal.halfs_root:
+                if best is None or len(hal.halfs_root) > len(best.halfs_root):
+                    best = hal
+        return best
+
+    def lookup(self, filepath):
+        """Return the resource that owns the given driver file, or None"""
+        hal = self.hal_for(filepath)
+        return hal.lookup(filepath) if hal is not None else None
+
+    def tree_changed(self, filepath, created):
+        """Forward the creation or deletion of a file to its HAL object"""
+        hal = self.hal_for(filepath)
+        if hal is not None:
+            hal.tree_changed(filepath, created)
+
+    def install_loop(self, loop=None):
+        """
+        Install the callbacks of all devices in given asyncio loop
+        (or the default event loop if None)
+        """
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.loop = loop
+
+        hals = list(self.devices.values())
+        for hal in hals:
+            hal.use_loop(loop)
+            hal.connect_events()
+
+        self.watcher = InotifyWatch(
+            hals[0].halfs_root,
+            mask=hals[0].inotify_mask,
+            resolve=self.lookup,
+            on_tree_change=self.tree_changed)
+        for hal in hals[1:]:
+            self.watcher.watch_tree(hal.halfs_root)
+
+        for hal in hals:
+            hal.watcher = self.watcher
+            hal.scheduler.start(loop)
+            if hal.known_state is not None:
+                asyncio.async(hal.record_state(), loop=loop)
+        loop.add_reader(self.watcher.fd, self.read_changes)
+        return loop
+
+    def read_changes(self):
+        """Dispatch pending filesystem writes to the HAL objects"""
+        changes = self.watcher.get_all()
+        by_hal = OrderedDict()
+        for resource in changes:
+            by_hal.setdefault(resource.hal, []).append(resource)
+        if not self.watcher.overflowed:
+            for hal, resources in by_hal.items():
+                hal.dispatch_changes(resources)
+            return
+        # Events of any device may be lost
+        for hal in self.devices.values():
+            hal.changes_overflowed(by_hal.get(hal, []))
+
+    def run(self, loop=None):
+        """
+        Run the callbacks of all devices in given asyncio loop,
+        or the default one if None
+        """
+        loop = self.install_loop(loop)
+        loop.run_forever()
+
+    def close(self):
+        """Stop watching the trees, and close all HAL objects"""
+        if self.watcher is not None:
+            self.loop.remove_reader(self.watcher.fd)
+            os.close(self.watcher.fd)
+            self.watcher = None
+        for hal in self.devices.values():
+            # The shared watcher is already closed
+            hal.watcher = None
+            hal.close()
+
+    def on_trigger(self, match_name=None, match_state=None, device=None,
+                   **limits):
+        """
+        Register a function to be called when a trigger of the given device
+        (of any device if None) changes; see HAL.on_trigger. To know the
+        device of an event, register the function once per device.
+        """
+        def wrapper(fun):
+            for hal in self.select(device):
+                hal.on_trigger(match_name, match_state, **limits)(fun)
+            return fun
+        return wrapper
+
+    def on_change(self, hal_type, name, device=None, **limits):
+        """
+        Register a function to be called when the resource hal_type/name of
+        the given device (of any device having one if None) changes. Raise
+        KeyError if the device, or all devices, have no such resource.
+        """
+        hals = [hal for hal in self.select(device)
+                if name in getattr(hal, hal_type)]
+        if not hals:
+            where = "device " + device if device else "any device"
+            raise KeyError("No {}/{} on {}".format(hal_type, name, where))
+
+        def wrapper(fun):
+            for hal in hals:
+                getattr(hal, hal_type)[name].on_change(fun, **limits)
+            return fun
+        return wrapper
+
+    def snapshot(self):
+        """Return a dict mapping each device name to its HAL.snapshot()"""
+        return OrderedDict(
+            (device, hal.snapshot()) for device, hal in self.devices.items())
+
+    @asyncio.coroutine
+    def asnapshot(self):
+        """Coroutine version of snapshot, reading all devices concurrently"""
+        loop = self.loop or asyncio.get_event_loop()
+        snapshots = yield from asyncio.gather(
+            *[hal.asnapshot() for hal in self.devices.values()], loop=loop)
+        return OrderedDict(zip(self.devices, snapshots))
+
+    def stats(self):
+        """Return a dict mapping each device name to its HAL.stats()"""
+        return OrderedDict(
+            (device, hal.stats()) for device, hal in self.devices.items())
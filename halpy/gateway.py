@@ -0,0 +1,210 @@
+"""
+A server streaming the state of a HAL object to many clients, on a TCP or
+UNIX socket. The gateway keeps the state of all resources up to date from
+the events dispatched by the HAL object, so that the hardware is read once
+whatever the number of clients.
+
+Messages are JSON objects, one per line. A new client first receives the
+full state, then only the resources that changed:
+
+    {"snapshot": {"switchs": {"power": true}, ...}, "time": 1445012345.6}
+    {"delta": {"triggers": {"door": false}}, "time": 1445012346.2}
+
+Deltas for a slow client are merged while it has not read the previous
+ones (only the latest state of each resource is kept), so that a slow
+client never slows down the others nor makes the gateway memory grow.
+
+:Example:
+
+>>> gateway = Gateway(hal)
+>>> loop.run_until_complete(gateway.start(port=8642))
+>>> hal.run()
+"""
+
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from collections.abc import Mapping
+
+# Size of the socket buffer of a client above which deltas are coalesced
+MAX_BUFFER = 64 * 1024
+
+# Size of the chunks read (and ignored) from the clients
+READ_BUFSIZE = 4096
+
+
+def merge(state, delta):
+    """Update state ({hal_type: {name: value}}) with delta, in place"""
+    for hal_type, resources in delta.items():
+        state.setdefault(hal_type, {}).update(resources)
+
+
+class Subscriber(object):
+    """
+    A client of the gateway. Deltas are merged in pending, and sent when
+    the client socket buffer has room for them.
+    """
+
+    def __init__(self, writer, loop, max_buffer=MAX_BUFFER):
+        self.writer = writer
+        self.pending = {}
+        self.ready = asyncio.Event(loop=loop)
+        self.sent = 0
+        self.coalesced = 0
+        writer.transport.set_write_buffer_limits(high=max_buffer)
+
+    def send(self, kind, state):
+        """Write a message to the client"""
+        message = {kind: state, 'time': time.time()}
+        line = json.dumps(message, separators=(',', ':'), sort_keys=True)
+        self.writer.write(line.encode() + b'\n')
+        self.sent += 1
+
+    def push(self, delta):
+        """Queue a delta, merged with those not sent yet"""
+        if self.ready.is_set():
+            self.coalesced += 1
+        merge(self.pending, delta)
+        self.ready.set()
+
+    @asyncio.coroutine
+    def run(self):
+        """Send the pending deltas, as fast as the client reads them"""
+        try:
+            while True:
+                yield from self.writer.drain()
+                yield from self.ready.wait()
+                self.ready.clear()
+                delta, self.pending = self.pending, {}
+                self.send('delta', delta)
+        except ConnectionError:
+            pass
+
+
+class Gateway(object):
+    """Stream the state of a HAL object to the clients of a socket server"""
+
+    def __init__(self, hal, loop=None, max_buffer=MAX_BUFFER):
+        self.hal = hal
+        self.loop = loop or hal.loop or asyncio.get_event_loop()
+        self.max_buffer = max_buffer
+        # None until the snapshot is read
+        self.state = None
+        # Deltas published while the snapshot is read
+        self.early_deltas = []
+        self.subscribers = []
+        self.server = None
+        # Changed resources whose state is not read yet
+        self.dirty = OrderedDict()
+        self.changed = asyncio.Event(loop=self.loop)
+        self.updater = None
+
+    @asyncio.coroutine
+    def start(self, host='localhost', port=None, socket_path=None):
+        """
+        Coroutine reading the state of all resources, then listening on the
+        UNIX socket socket_path if given, or on the TCP host and port.
+        Events dispatched while the state is read are applied over it.
+        Return the asyncio Server.
+        """
+        self.hal.add_observer(self.observe)
+        self.updater = asyncio.async(self.update(), loop=self.loop)
+        snapshot = yield from self.hal.asnapshot()
+        state = {
+            hal_type: {
+                name: dict(value) if isinstance(value, Mapping) else value
+                for name, value in resources.items()}
+            for hal_type, resources in snapshot.items()}
+        for delta in self.early_deltas:
+            merge(state, delta)
+        self.state, self.early_deltas = state, []
+        if socket_path is not None:
+            self.server = yield from asyncio.start_unix_server(
+                self.client_connected, socket_path, loop=self.loop)
+        else:
+            self.server = yield from asyncio.start_server(
+                self.client_connected, host, port, loop=self.loop)
+        return self.server
+
+    def close(self):
+        """Stop the server and disconnect all clients"""
+        self.hal.remove_observer(self.observe)
+        if self.updater is not None:
+            self.updater.cancel()
+        if self.server is not None:
+            self.server.close()
+        for subscriber in self.subscribers:
+            subscriber.writer.close()
+
+    def read_states(self, resources):
+        """
+        Return the states of resources, as in a snapshot (blocking, run in
+        the HAL I/O executor)
+        """
+        states = []
+        for resource in resources:
+            props = self.hal.snapshot_properties[resource.hal_type]
+            values = {}
+            for prop in props:
+                try:
+                    values[prop] = getattr(resource, prop)
+                except OSError:
+                    values[prop] = None
+            states.append(values[props[0]] if len(props) == 1 else values)
+        return states
+
+    def observe(self, kind, items):
+        """Observer of the HAL dispatch (see HAL.add_observer)"""
+        if kind == 'triggers':
+            self.publish({'triggers': dict(items)})
+            return
+        for resource in items:
+            if resource.hal_type in self.hal.snapshot_properties:
+                self.dirty[resource.hal_type, resource.name] = resource
+        if self.dirty:
+            self.changed.set()
+
+    @asyncio.coroutine
+    def update(self):
+        """
+        Read the state of the changed resources in the I/O executor, one
+        batch at a time, and publish it. Resources changing again during a
+        read are read again in the next batch.
+        """
+        while True:
+            yield from self.changed.wait()
+            self.changed.clear()
+            resources = list(self.dirty.values())
+            self.dirty.clear()
+            states = yield from self.hal.run_io(self.read_states, resources)
+            delta = {}
+            for resource, state in zip(resources, states):
+                delta.setdefault(resource.hal_type, {})[resource.name] = state
+            self.publish(delta)
+
+    def publish(self, delta):
+        """Apply delta to the state, and queue it for all clients"""
+        if self.state is None:
+            self.early_deltas.append(delta)
+            return
+        merge(self.state, delta)
+        for subscriber in self.subscribers:
+            subscriber.push(delta)
+
+    @asyncio.coroutine
+    def client_connected(self, reader, writer):
+        subscriber = Subscriber(writer, self.loop, self.max_buffer)
+        subscriber.send('snapshot', self.state)
+        self.subscribers.append(subscriber)
+        sender = asyncio.async(subscriber.run(), loop=self.loop)
+        try:
+            # Clients don't send anything, wait until they disconnect
+            while (yield from reader.read(READ_BUFSIZE)):
+                pass
+        except ConnectionError:
+            pass
+        finally:
+            sender.cancel()
+            self.subscribers.remove(subscriber)
+            writer.close()
@@ -2,7 +2,7 @@
 
 
 from math import sin, pi
-from functools import reduce  # Py3 compat
+from itertools import chain, islice
 
 
 class Note(object):
@@ -38,9 +38,25 @@ class Partition(object):
 
     def to_frames(self, base_duration=4):
         """See Note.to_frames"""
-        return reduce(
-            lambda res, n: res + n.to_frames(base_duration), self.notes, []
-        )
+        return list(self.iter_frames(base_duration))
+
+    def iter_frames(self, base_duration=4):
+        """Lazily yield the frames of to_frames, note after note"""
+        return chain.from_iterable(
+            n.to_frames(base_duration) for n in self.notes)
+
+
+def chunks(frames, size=255):
+    """
+    Split an iterable of frames in bytes objects of at most size frames,
+    suitable for Animation upload
+    """
+    frames = iter(frames)
+    while True:
+        chunk = bytes(islice(frames, size))
+        if not chunk:
+            return
+        yield chunk
 
 
 def sinusoid(n_frames=255, val_min=0, val_max=255):
@@ -1,10 +1,21 @@
 # Copyright UrLab 2014-2015
 # Florentin Hennecker, Nikita Marchant, Titouan Christophe
 
-from datetime import datetime
 from os import path, listdir
-from .simple_inotify import InotifyWatch
-from io import FileIO
+from .simple_inotify import InotifyWatch, IN_CLOSE_WRITE
+from .metrics import Metrics
+from .scheduler import Scheduler, Job, parse_time
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, partialmethod
+from itertools import chain
+from threading import Lock
+from types import MappingProxyType
+from array import array
+import hashlib
+import time
+import os
 import socket
 import asyncio
 import warnings
@@ -12,6 +23,12 @@ from logging import getLogger
 
 log = getLogger(__name__)
 
+# Maximal number of bytes taken from the events socket at each wakeup
+EVENTS_BUFSIZE = 4096
+
+# Maximal number of bytes read from a driver file
+READ_BUFSIZE = 4096
+
 
 class AttrDict(dict):
     """
@@ -23,6 +40,248 @@ class AttrDict(dict):
         self.__dict__ = self
 
 
+class ResourceCollection(Mapping):
+    """
+    All the resources of one type, listed from the driver filesystem on
+    first access. Resources are also accessible as attributes, st.
+    hal.switchs['power'] is hal.switchs.power
+    """
+    def __init__(self, hal, klass):
+        self.hal = hal
+        self.klass = klass
+        self.resources = None
+
+    def load(self):
+        """Return the dict of resources, listing them if not done yet"""
+        if self.resources is None:
+            try:
+                entries = listdir(self.hal.expand_path(self.klass.hal_type))
+            except FileNotFoundError:
+                entries = []
+            self.resources = {e: self.klass(self.hal, e) for e in entries}
+        return self.resources
+
+    def add(self, name):
+        """Register a resource that appeared in the driver filesystem"""
+        if self.resources is not None and name not in self.resources:
+            self.resources[name] = self.klass(self.hal, name)
+
+    def discard(self, name):
+        """Forget a resource that disappeared from the driver filesystem"""
+        if self.resources is not None:
+            self.resources.pop(name, None)
+
+    def __getitem__(self, name):
+        return self.load()[name]
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __len__(self):
+        return len(self.load())
+
+    def __getattr__(self, name):
+        if name in ('hal', 'klass', 'resources'):
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class Snapshot(Mapping):
+    """
+    A read-only view of the state of all resources at a given time, mapping
+    each resource type to a mapping {resource_name: state}. The state of an
+    animation is a mapping of its properties.
+
+    :Example:
+
+    >>> snap = hal.snapshot()
+    >>> snap['switchs']['power']  # => True
+    >>> snap['animations']['ledstrip']['fps']  # => '25'
+    >>> snap.timestamp  # => 1445012345.67
+    """
+    def __init__(self, state, timestamp):
+        self.state = MappingProxyType(state)
+        self.timestamp = timestamp
+
+    def __getitem__(self, key):
+        return self.state[key]
+
+    def __iter__(self):
+        return iter(self.state)
+
+    def __len__(self):
+        return len(self.state)
+
+
+class EventsReader(object):
+    """
+    Buffered parser for the driver events socket. Each chunk of bytes given
+    to feed() is split into complete 'name:state\\n' lines; an incomplete
+    trailing line is kept until the next chunk arrives.
+    """
+    def __init__(self):
+        self.pending = b''
+
+    def feed(self, data):
+        """Return the list of (trigger_name, state) events completed by data"""
+        lines = (self.pending + data).split(b'\n')
+        self.pending = lines.pop()
+        events = []
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            name, statestr = line.decode().split(':')
+            events.append((name, statestr == '1'))
+        return events
+
+
+class FDCache(object):
+    """
+    A bounded pool of file descriptors opened on driver files, keyed by their
+    path relative to the HAL root. When the pool is full, the least recently
+    used descriptor is closed. Files are read with pread at offset 0, so that
+    a read costs a single syscall once the file is opened.
+
+    Only reads are pooled: writes must close the file, so that they emit the
+    IN_CLOSE_WRITE inotify event seen by change handlers (in this process
+    and in any other one watching the tree).
+    """
+    def __init__(self, root, size):
+        self.root = root
+        self.size = size
+        self.fds = OrderedDict()
+        # The cache may be used from the HAL I/O threads
+        self.lock = Lock()
+
+    def get(self, filepath, flags):
+        """Return a file descriptor opened with flags on given filepath"""
+        key = filepath, flags
+        with self.lock:
+            fd = self.fds.pop(key, None)
+            if fd is None:
+                fd = os.open(path.join(self.root, *filepath), flags)
+                if len(self.fds) >= self.size:
+                    _, lru_fd = self.fds.popitem(last=False)
+                    os.close(lru_fd)
+            self.fds[key] = fd
+        return fd
+
+    def discard(self, filepath, flags):
+        """Close the descriptor opened with flags on filepath, if any"""
+        with self.lock:
+            fd = self.fds.pop((filepath, flags), None)
+        if fd is not None:
+            os.close(fd)
+
+    def discard_tree(self, prefix):
+        """Close the descriptors opened on files under the path prefix"""
+        with self.lock:
+            keys = [key for key in self.fds
+                    if key[0][:len(prefix)] == prefix]
+            fds = [self.fds.pop(key) for key in keys]
+        for fd in fds:
+            os.close(fd)
+
+    def read(self, filepath):
+        """Return the content of the file given in parameter, as bytes"""
+        fd = self.get(filepath, os.O_RDONLY)
+        try:
+            return os.pread(fd, READ_BUFSIZE, 0)
+        except OSError:
+            self.discard(filepath, os.O_RDONLY)
+            raise
+
+    def close(self):
+        """Close all cached file descriptors"""
+        with self.lock:
+            while self.fds:
+                _, fd = self.fds.popitem()
+                os.close(fd)
+
+
+class BoundedHandler(object):
+    """
+    A handler of which at most `limit` calls run concurrently. When the limit
+    is reached, new calls are queued (at most queue_size of them), and the
+    policy tells what to do when the queue is full:
+      - 'drop-new': ignore the new call
+      - 'drop-old': drop the oldest queued call, and queue the new one
+                    (requires a queue_size of at least 1)
+      - 'latest': only keep the latest call (the queue size is then 1)
+      - 'cancel': cancel the oldest running call, and start the new one
+    Calling the handler returns a future for the result of that call, which
+    is cancelled if the call is dropped. Calls run in loop (the default event
+    loop if None).
+    """
+    policies = ('drop-new', 'drop-old', 'latest', 'cancel')
+
+    def __init__(self, func, limit, queue_size=0, policy='drop-new',
+                 loop=None):
+        if policy not in self.policies:
+            raise ValueError("Unknown overflow policy {}".format(policy))
+        if limit < 1:
+            raise ValueError("Illegal concurrency limit {}".format(limit))
+        if policy == 'drop-old' and queue_size < 1:
+            raise ValueError("The drop-old policy needs a queue")
+        self.func = func
+        self.__name__ = func.__name__
+        self.limit = limit
+        self.policy = policy
+        self.queue_size = 1 if policy == 'latest' else queue_size
+        self.queue = deque()
+        self.running = []
+        self.dropped = 0
+        self.loop = loop
+
+    def __call__(self, *args):
+        future = asyncio.Future(loop=self.loop)
+        if len(self.running) < self.limit:
+            self.start(args, future)
+        elif self.policy == 'cancel':
+            self.running.pop(0).cancel()
+            self.dropped += 1
+            self.start(args, future)
+        elif len(self.queue) < self.queue_size:
+            self.queue.append((args, future))
+        elif self.queue and self.policy in ('drop-old', 'latest'):
+            self.queue.popleft()[1].cancel()
+            self.dropped += 1
+            self.queue.append((args, future))
+        else:
+            future.cancel()
+            self.dropped += 1
+        return future
+
+    def start(self, args, future):
+        """Run the handler with args, its result going to future"""
+        r = self.func(*args)
+        if not asyncio.iscoroutine(r):
+            future.set_result(r)
+            return
+        task = asyncio.async(r, loop=self.loop)
+        self.running.append(task)
+        task.add_done_callback(partial(self.done, future))
+
+    def done(self, future, task):
+        """Forward the result of a finished call, and start queued ones"""
+        if task in self.running:
+            self.running.remove(task)
+        if future.done():
+            pass
+        elif task.cancelled():
+            future.cancel()
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+        while self.queue and len(self.running) < self.limit:
+            self.start(*self.queue.popleft())
+
+
 class Resource(object):
     """
     Base class for all HAL resources (switchs, anims, triggers, sensors, rgbs).
@@ -47,19 +306,57 @@ class Resource(object):
         full_path = (self.hal_type, self.name) + path
         return self.hal.write(value, *full_path, **kwargs)
 
-    def on_change(self, func):
+    @asyncio.coroutine
+    def aread(self, *path, **kwargs):
+        """Coroutine version of read, run in the HAL I/O executor"""
+        full_path = (self.hal_type, self.name) + path
+        return (yield from self.hal.aread(*full_path, **kwargs))
+
+    @asyncio.coroutine
+    def awrite(self, value, *path, **kwargs):
+        """Coroutine version of write, run in the HAL I/O executor"""
+        full_path = (self.hal_type, self.name) + path
+        return (yield from self.hal.awrite(value, *full_path, **kwargs))
+
+    @asyncio.coroutine
+    def aget(self, attr):
+        """
+        Coroutine returning the value of the property attr, computed in the
+        HAL I/O executor. Each resource also defines shortcuts for its
+        properties, such as `yield from switch.get_on()`
+        """
+        return (yield from self.hal.run_io(getattr, self, attr))
+
+    @asyncio.coroutine
+    def aset(self, attr, value):
+        """
+        Coroutine setting the property attr in the HAL I/O executor. Each
+        resource also defines shortcuts for its properties, such as
+        `yield from switch.set_on(True)`
+        """
+        return (yield from self.hal.run_io(setattr, self, attr, value))
+
+    def on_change(self, func=None, **limits):
         """
         Register a callback to be executed everytime this resource is modified
+        The concurrency of the callback may be limited (see HAL.on_trigger)
 
         :Example:
 
         >>> @resource.on_change
         >>> def resource_has_changed(resource):
         >>>     print(resource.name + " has changed")
+
+        >>> @resource.on_change(max_concurrent=1, policy='latest')
+        >>> def resource_has_changed(resource):
+        >>>     yield from show_slowly(resource)
         """
+        if func is None:
+            return partial(self.on_change, **limits)
         pattern = type(self), self.name
-        installed = self.hal.change_events.get(pattern, [])
-        self.hal.change_events[pattern] = installed + [asyncio.coroutine(func)]
+        handlers = self.hal.change_events.setdefault(pattern, [])
+        handlers.append(self.hal.make_handler(func, **limits))
+        self.hal.change_index = None
         return func
 
 
@@ -69,10 +366,85 @@ class Animation(Resource):
     (the PWM values), which are played at a certain speed. If the animation is
     looping, when the last frame has been played, it returns to the first one,
     otherwise it stops.
+
+    While the HAL loop is installed, the last uploaded frames (as a hash),
+    fps and loop values are memoized: writing them again is a no-op, unless
+    the file was changed meanwhile (as seen by inotify) or the write is
+    forced (see Animation.configure). Without inotify, external writes
+    could not be noticed, hence all writes are made.
+    The play value is not memoized, because the driver resets it by itself
+    at the end of non-looping animations.
     """
 
     hal_type = "animations"
 
+    def __init__(self, hal, name):
+        super(Animation, self).__init__(hal, name)
+        # filename -> memo of the last value written to this file
+        self.uploaded = {}
+
+    @staticmethod
+    def memo(filename, value):
+        """Return the value memoized for a write of value to filename"""
+        if filename == "frames":
+            return hashlib.sha1(value).digest()
+        return value
+
+    def write_changed(self, value, filename, force=False, **kwargs):
+        """
+        Write value to filename, unless it is the value memoized for the
+        last write. Return True if the file was written.
+        """
+        if self.hal.watcher is None:
+            self.uploaded.clear()
+            self.write(value, filename, **kwargs)
+            return True
+        memo = self.memo(filename, value)
+        if not force and self.uploaded.get(filename) == memo:
+            self.hal.skipped_writes += 1
+            return False
+        self.write(value, filename, **kwargs)
+        self.uploaded[filename] = memo
+        return True
+
+    def refresh_uploaded(self):
+        """
+        Check the memoized values against the files, and forget the ones
+        that were changed by someone else (called on inotify changes)
+        """
+        for filename, memo in list(self.uploaded.items()):
+            try:
+                binary = filename == "frames"
+                value = self.read(filename, binary=binary)
+            except OSError:
+                value = None
+            if value is None or self.memo(filename, value) != memo:
+                del self.uploaded[filename]
+
+    def configure(self, frames=None, fps=None, looping=None, force=False):
+        """
+        Set the given frames, fps and looping values, skipping those that
+        are already uploaded unless force is True. Return the number of
+        written files.
+
+        :Example:
+
+        >>> anim.configure(frames=[0, 255], fps=10, looping=True)
+        >>> anim.configure(frames=[0, 255], force=True)  # Upload anyway
+        """
+        written = 0
+        if fps is not None:
+            fps = int(fps)
+            assert 4 <= fps <= 1024
+            written += self.write_changed("%d" % fps, "fps", force)
+        if looping is not None:
+            written += self.write_changed(
+                "1" if looping else "0", "loop", force)
+        if frames is not None:
+            written += self.write_changed(
+                self.encode_frames(frames), "frames", force, binary=True)
+        return written
+
     @property
     def fps(self):
         """Return the animation speed in frames per second"""
@@ -81,9 +453,7 @@ class Animation(Resource):
     @fps.setter
     def fps(self, value):
         """Set the animation speed, in frames per second"""
-        value = int(value)
-        assert 4 <= value <= 1024
-        return self.write("%d" % value, "fps")
+        self.configure(fps=value)
 
     @property
     def playing(self):
@@ -103,37 +473,92 @@ class Animation(Resource):
     @looping.setter
     def looping(self, value):
         """Set to true to make the animation looping"""
-        self.write("1" if value else "0", "loop")
+        self.configure(looping=value)
 
     @property
     def frames(self):
         """Return the PWM values, as a list of integers"""
         return list(self.read("frames", binary=True))
 
+    @property
+    def frames_view(self):
+        """Return the PWM values, as a read-only memoryview of bytes"""
+        return memoryview(self.read("frames", binary=True))
+
     @frames.setter
     def frames(self, value):
         """
         Set the animation PWM values (at most 255), which are either integers
-        in the range [0, 255] or floats in the range [0, 1]
+        in the range [0, 255] or floats in the range [0, 1]. Bytes-like
+        objects (bytes, bytearray, memoryview or array of unsigned bytes)
+        and NumPy arrays are uploaded without intermediate copies; don't
+        modify them before the upload if writes are coalesced.
 
         :Example:
 
         >>> anim.frames = [255, 128, 0, 128]
         >>> anim.frames = [1.0, 0.5, 0, 0.5]
+        >>> anim.frames = numpy.linspace(0, 1, 100)
         """
-        # Format frames
-        intify = lambda x: x if isinstance(x, int) else int(255 * x)
-        frames = [intify(x) for x in value]
+        self.configure(frames=value)
+
+    @staticmethod
+    def encode_frames(value):
+        """Return a bytes-like object suitable for a frames upload"""
+        if isinstance(value, (bytes, bytearray)):
+            frames = value
+        elif isinstance(value, (memoryview, array)):
+            frames = memoryview(value)
+            if frames.format != 'B' or frames.ndim != 1:
+                return Animation.encode_frames(frames.tolist())
+            if not frames.c_contiguous:
+                frames = bytes(frames)
+        elif hasattr(value, 'dtype'):
+            frames = Animation.encode_ndarray(value)
+        else:
+            # Format frames
+            intify = lambda x: x if isinstance(x, int) else int(255 * x)
+            frames = [intify(x) for x in value]
+            for elem in frames:
+                if not (isinstance(elem, int) and 0 <= elem <= 255):
+                    raise ValueError("Illegal value {}".format(elem))
+            frames = bytes(frames)
 
         # Validation
         if not (0 < len(frames) <= 255):
             raise ValueError("Illegal animation len !")
-        for elem in frames:
-            if not (isinstance(elem, int) and 0 <= elem <= 255):
-                raise ValueError("Illegal value {}".format(elem))
-
-        # Upload !
-        self.write(bytes(frames), "frames", binary=True)
+        return frames
+
+    @staticmethod
+    def encode_ndarray(value):
+        """Convert a NumPy array to a memoryview of unsigned bytes"""
+        if value.ndim != 1 or not (0 < len(value) <= 255):
+            raise ValueError("Illegal animation shape {}".format(value.shape))
+        kind = value.dtype.kind
+        if kind not in 'fiu':
+            raise ValueError("Illegal frames type {}".format(value.dtype))
+        if value.dtype.str != '|u1':
+            lo, hi = value.min(), value.max()
+            top = 1 if kind == 'f' else 255
+            if lo < 0 or hi > top:
+                raise ValueError(
+                    "Illegal value {}".format(lo if lo < 0 else hi))
+            if kind == 'f':
+                value = value * 255
+            value = value.astype('u1')
+        if not value.flags.c_contiguous:
+            value = value.copy()
+        return memoryview(value)
+
+    get_fps = partialmethod(Resource.aget, 'fps')
+    set_fps = partialmethod(Resource.aset, 'fps')
+    get_playing = partialmethod(Resource.aget, 'playing')
+    set_playing = partialmethod(Resource.aset, 'playing')
+    get_looping = partialmethod(Resource.aget, 'looping')
+    set_looping = partialmethod(Resource.aset, 'looping')
+    get_frames = partialmethod(Resource.aget, 'frames')
+    get_frames_view = partialmethod(Resource.aget, 'frames_view')
+    set_frames = partialmethod(Resource.aset, 'frames')
 
     def upload(self, frames):
         """Old API for animation.frames = ..."""
@@ -159,6 +584,67 @@ class Switch(Resource):
         """Activate the output if set to True"""
         self.write("1" if value else "0")
 
+    get_on = partialmethod(Resource.aget, 'on')
+    set_on = partialmethod(Resource.aset, 'on')
+
+
+class Fade(object):
+    """
+    A transition of an Rgb led through precomputed CSS colors. The steps
+    are scheduled on absolute deadlines of the loop clock, so that the fade
+    does not drift; when the loop is late, the missed steps are skipped
+    rather than written in a burst. The future is resolved with the number
+    of written colors at the end of the fade, or fails with the error of a
+    write; cancelling it stops the fade.
+    """
+
+    def __init__(self, rgb, steps, interval, loop):
+        self.rgb = rgb
+        self.steps = steps
+        self.interval = interval
+        self.loop = loop
+        self.start = loop.time()
+        self.current = 0
+        self.written = 0
+        self.skipped = 0
+        self.future = asyncio.Future(loop=loop)
+        self.future.add_done_callback(self.stopped)
+        self.handle = loop.call_at(self.start + interval, self.step)
+
+    @property
+    def css(self):
+        """The color currently displayed by the fade"""
+        return self.steps[self.current]
+
+    def step(self):
+        # The loop may call us a bit early (up to its clock resolution)
+        last = len(self.steps) - 1
+        i = last
+        if self.interval > 0:
+            elapsed = self.loop.time() - self.start
+            i = min(last, max(self.current + 1, int(elapsed / self.interval)))
+        self.skipped += i - self.current - 1
+        if self.steps[i] != self.css:
+            try:
+                self.rgb.css = self.steps[i]
+            except Exception as exc:
+                self.handle = None
+                self.future.set_exception(exc)
+                return
+            self.written += 1
+        self.current = i
+        if i == last:
+            self.handle = None
+            self.future.set_result(self.written)
+        else:
+            deadline = self.start + (i + 1) * self.interval
+            self.handle = self.loop.call_at(deadline, self.step)
+
+    def stopped(self, future):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
 
 class Rgb(Resource):
     """
@@ -169,6 +655,11 @@ class Rgb(Resource):
     """
     hal_type = 'rgbs'
 
+    def __init__(self, hal, name):
+        super(Rgb, self).__init__(hal, name)
+        # Running fade, if any (see Rgb.fade_to)
+        self.fading = None
+
     @property
     def css(self):
         """Return the actual color as a CSS hex string ('#rrggbb')"""
@@ -190,9 +681,58 @@ class Rgb(Resource):
     @color.setter
     def color(self, color):
         """Set the actual color from a tuple of bytes (r, g, b)"""
+        self.css = '#%02x%02x%02x' % self.parse_color(color)
+
+    @staticmethod
+    def parse_color(color):
+        """
+        Return a tuple of bytes (r, g, b) from a CSS hex string or from a
+        tuple of bytes or floats in [0, 1]
+        """
+        if isinstance(color, str):
+            assert color[0] == '#' and len(color) in (4, 7)
+            if len(color) == 4:
+                color = '#' + ''.join(c * 2 for c in color[1:])
+            return tuple(int(color[i:i + 2], 16) for i in (1, 3, 5))
         intify = lambda x: int(x * 255) if isinstance(x, float) else int(x)
-        r, g, b = [max(0, min(255, intify(c))) for c in color]
-        self.css = '#%02x%02x%02x' % (r, g, b)
+        return tuple(max(0, min(255, intify(c))) for c in color)
+
+    def fade_to(self, color, duration, easing=None, fps=25, loop=None):
+        """
+        Progressively change the color to color (see Rgb.parse_color) in
+        duration seconds, with fps intermediate colors per second. easing is
+        a function mapping the elapsed fraction of the fade to the fraction
+        of the color change, in [0, 1] (linear if None). A new fade cancels
+        the running one, and starts from its current color. Return a future
+        (see Fade), which can be waited for.
+
+        :Example:
+
+        >>> yield from rgb.fade_to('#ff8000', 2, easing=lambda t: t * t)
+        """
+        loop = loop or self.hal.loop or asyncio.get_event_loop()
+        if self.fading is not None and not self.fading.future.done():
+            start = self.parse_color(self.fading.css)
+            self.fading.future.cancel()
+        else:
+            start = self.color
+        stop = self.parse_color(color)
+
+        n = max(1, int(round(duration * fps)))
+        easing = easing or (lambda t: t)
+        steps = []
+        for k in range(n + 1):
+            t = easing(k / n)
+            steps.append('#%02x%02x%02x' % tuple(
+                int(round(a + (b - a) * t)) for a, b in zip(start, stop)))
+
+        self.fading = Fade(self, steps, duration / n, loop)
+        return self.fading.future
+
+    get_css = partialmethod(Resource.aget, 'css')
+    set_css = partialmethod(Resource.aset, 'css')
+    get_color = partialmethod(Resource.aget, 'color')
+    set_color = partialmethod(Resource.aset, 'color')
 
 
 class Trigger(Resource):
@@ -204,12 +744,14 @@ class Trigger(Resource):
         """Return True if the input is active, False otherwise"""
         return self.read().strip() == "1"
 
-    def on_trigger(self, value=None):
+    get_on = partialmethod(Resource.aget, 'on')
+
+    def on_trigger(self, value=None, **limits):
         """
         Register a function to be called when the input state changes.
         See also HAL.on_trigger
         """
-        return self.hal.on_trigger(self.name, value)
+        return self.hal.on_trigger(self.name, value, **limits)
 
 
 class Sensor(Resource):
@@ -221,6 +763,8 @@ class Sensor(Resource):
         """Return the actual input value (a float between 0 and 1)"""
         return float(self.read().strip('\x00').strip())
 
+    get_value = partialmethod(Resource.aget, 'value')
+
 
 class HAL(object):
     """Main HAL class."""
@@ -228,33 +772,236 @@ class HAL(object):
     resource_mapping = {
         c.hal_type: c for c in (Animation, Switch, Trigger, Sensor, Rgb)}
 
-    def __init__(self, halfs_root):
-        """Initialize a HAL object, given its Filesystem mountpoint"""
+    # Properties that make up the state of each type of resource
+    snapshot_properties = {
+        'switchs': ('on',),
+        'triggers': ('on',),
+        'sensors': ('value',),
+        'rgbs': ('css',),
+        'animations': ('playing', 'looping', 'fps'),
+    }
+
+    # Inotify events that signal a change of a resource
+    inotify_mask = IN_CLOSE_WRITE
+
+    # Files that change without inotify events, hence are never cached: all
+    # files of the uncached types, and the uncached files of any resource
+    # (the driver resets 'play' at the end of non-looping animations)
+    uncached_types = ('sensors', 'driver')
+    uncached_files = ('play',)
+
+    # Properties compared to find the resources modified while inotify events
+    # were lost (resources changing without inotify events are left out)
+    resync_properties = {
+        'switchs': ('on',),
+        'triggers': ('on',),
+        'rgbs': ('css',),
+        'animations': ('playing', 'looping', 'fps', 'frames'),
+    }
+
+    def __init__(self, halfs_root, fd_cache_size=0, coalesce_writes=False,
+                 cache_reads=False, io_workers=4, io_limit=16,
+                 resync_on_overflow=True):
+        """
+        Initialize a HAL object, given its Filesystem mountpoint. If
+        fd_cache_size is not 0, keep at most that many driver files open
+        between reads (see FDCache). If coalesce_writes is True,
+        writes are postponed to the next loop iteration (see HAL.write).
+        If cache_reads is True, the content of resource files is kept in
+        memory until inotify reports a write, once the loop has been
+        installed. The coroutine API (aread, awrite, and the
+        get_xxx/set_xxx methods of resources) runs blocking I/O in a pool
+        of io_workers threads, with at most io_limit pending operations.
+        If resync_on_overflow is True, changes lost when the inotify queue
+        overflows are recovered by re-reading all resources (see HAL.resync).
+        """
         self.halfs_root = halfs_root
+        self.resync_on_overflow = resync_on_overflow
+        # Last known state of the resources, compared on resync (None if not
+        # resync_on_overflow)
+        self.known_state = {} if resync_on_overflow else None
+        self.overflows = 0
+        self.io_workers = io_workers
+        self.io_limit = io_limit
+        self.io_executor = None
+        self.io_semaphore = None
+        self.cache_reads = cache_reads
+        self.read_cache = {}
+        self.loop = None
+        self.coalesce_writes = coalesce_writes
+        self.pending_writes = OrderedDict()
+        self.flush_handle = None
+        # Guards pending_writes and flush_handle
+        self.pending_lock = Lock()
+        self.flushed_writes = 0
+        self.dropped_writes = 0
+        # Writes of already uploaded animation values, see Animation.configure
+        self.skipped_writes = 0
+        self.fd_cache = None
+        if fd_cache_size > 0:
+            self.fd_cache = FDCache(halfs_root, fd_cache_size)
         for name, klass in self.resource_mapping.items():
-            try:
-                entries = listdir(path.join(self.halfs_root, name))
-                resources = AttrDict({e: klass(self, e) for e in entries})
-                setattr(self, name, resources)
-            except FileNotFoundError:
-                continue
+            setattr(self, name, ResourceCollection(self, klass))
         self.running = False
         self.trigger_events = {}
         self.change_events = {}
+        self.metrics = Metrics()
+        self.scheduler = Scheduler(self.call_handler)
+        self.observers = []
+        # Inotify watch of the tree and events socket, once the loop is
+        # installed
+        self.watcher = None
+        self.events_sock = None
+        # Flat views of the registered handlers, rebuilt after registrations
+        self.trigger_index = None
+        self.change_index = None
 
     def expand_path(self, *filepath):
         """Expand a filepath inside the driver filesystem"""
         return path.join(self.halfs_root, *filepath)
 
+    def cacheable(self, filepath):
+        """
+        Return True if the content of filepath may be kept in memory: only
+        while inotify reports the writes to the tree
+        """
+        return (self.cache_reads and self.watcher is not None and
+                filepath[0] not in self.uncached_types and
+                filepath[-1] not in self.uncached_files)
+
     def read(self, *filepath, **opts):
         """Returns a string with the content of the file given in parameter"""
-        mode = "rb" if opts.get('binary', False) else "r"
-        return FileIO(self.expand_path(*filepath), mode).read().strip()
+        binary = opts.get('binary', False)
+        pending = self.pending_writes.get(filepath)
+        if pending is not None:
+            value = pending[0]
+            return bytes(value) if binary else str(value).strip()
+
+        cached = self.cacheable(filepath)
+        if cached:
+            key = filepath[2:], binary
+            entries = self.read_cache.setdefault(filepath[:2], {})
+            if key in entries:
+                return entries[key]
+
+        if self.fd_cache:
+            content = self.fd_cache.read(filepath)
+        else:
+            with open(self.expand_path(*filepath), "rb") as f:
+                content = f.read()
+        if not binary:
+            content = content.decode().strip()
+
+        if cached:
+            entries[key] = content
+        return content
 
     def write(self, value, *filepath, **opts):
-        """Casts value to str and writes it to the file given in parameter"""
-        mode = "wb" if opts.get('binary', False) else "w"
-        FileIO(self.expand_path(*filepath), mode).write(value)
+        """
+        Casts value to str and writes it to the file given in parameter.
+        If writes are coalesced, the value is only written at the next loop
+        iteration; in the meantime, it replaces any previous value waiting
+        to be written to the same file.
+        """
+        if not self.coalesce_writes:
+            return self.write_now(value, *filepath, **opts)
+
+        # Writes may come from the I/O executor threads
+        with self.pending_lock:
+            if filepath in self.pending_writes:
+                self.dropped_writes += 1
+            self.pending_writes[filepath] = value, opts
+            if self.flush_handle is None:
+                loop = self.loop or asyncio.get_event_loop()
+                self.flush_handle = loop.call_soon_threadsafe(self.flush)
+
+    def write_now(self, value, *filepath, **opts):
+        """Like write, but never postponed"""
+        binary = opts.get('binary', False)
+        data = value if binary else str(value).encode()
+        with open(self.expand_path(*filepath), "wb") as f:
+            f.write(data)
+
+        if self.cacheable(filepath):
+            entries = self.read_cache.setdefault(filepath[:2], {})
+            entries.pop((filepath[2:], not binary), None)
+            entries[(filepath[2:], binary)] = (
+                bytes(value) if binary else str(value).strip())
+
+    @asyncio.coroutine
+    def run_io(self, func, *args):
+        """
+        Coroutine running func(*args) in the I/O executor, waiting for a slot
+        if io_limit operations are already in flight
+        """
+        loop = self.loop or asyncio.get_event_loop()
+        if self.io_semaphore is None:
+            self.io_semaphore = asyncio.Semaphore(self.io_limit, loop=loop)
+        with (yield from self.io_semaphore):
+            return (yield from loop.run_in_executor(
+                self.executor, func, *args))
+
+    @property
+    def executor(self):
+        """The thread pool running blocking I/O for the coroutine API"""
+        if self.io_executor is None:
+            self.io_executor = ThreadPoolExecutor(self.io_workers)
+        return self.io_executor
+
+    @asyncio.coroutine
+    def aread(self, *filepath, **opts):
+        """Coroutine version of read, run in the I/O executor"""
+        return (yield from self.run_io(partial(self.read, *filepath, **opts)))
+
+    @asyncio.coroutine
+    def awrite(self, value, *filepath, **opts):
+        """
+        Coroutine version of write, run in the I/O executor. Coalesced writes
+        are only recorded, hence return immediately.
+        """
+        if self.coalesce_writes:
+            return self.write(value, *filepath, **opts)
+        return (yield from self.run_io(
+            partial(self.write_now, value, *filepath, **opts)))
+
+    def invalidate(self, hal_type, name):
+        """Forget the cached content of the files of a resource"""
+        self.read_cache.pop((hal_type, name), None)
+
+    def flush(self):
+        """Immediately write all values postponed by coalesced writes"""
+        with self.pending_lock:
+            if self.flush_handle is not None:
+                self.flush_handle.cancel()
+                self.flush_handle = None
+            pending, self.pending_writes = self.pending_writes, OrderedDict()
+        for filepath, (value, opts) in pending.items():
+            self.write_now(value, *filepath, **opts)
+            self.flushed_writes += 1
+
+    def close(self):
+        """
+        Write pending values, stop watching the tree and the events socket,
+        close the files kept open and stop the I/O executor threads
+        """
+        self.flush()
+        if self.events_sock is not None:
+            if self.loop is not None:
+                self.loop.remove_reader(self.events_sock)
+            self.events_sock.close()
+            self.events_sock = None
+        if self.watcher is not None:
+            if self.loop is not None:
+                self.loop.remove_reader(self.watcher.fd)
+            os.close(self.watcher.fd)
+            self.watcher = None
+        self.read_cache.clear()
+        if self.fd_cache:
+            self.fd_cache.close()
+        if self.io_executor is not None:
+            self.io_executor.shutdown()
+            self.io_executor = None
+        self.scheduler.stop()
 
     def map_path(self, filepath):
         """Return the resource associated to given filepath"""
@@ -267,66 +1014,320 @@ class HAL(object):
             return
         return self.resource_mapping[parts[0]](self, parts[1])
 
-    def install_loop(self, loop=None):
+    def build_trigger_index(self):
         """
-        Install all callbacks in given asyncio loop
-        (or the default event loop if None)
+        Return a dict mapping (trigger_name, state) to the tuple of all
+        handlers to call for this event, including the wildcard ones.
+        Unregistered trigger names are found under (None, state).
         """
-        # Socket for triggers
-        events_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        events_sock.connect(path.join(self.halfs_root, "events"))
-
-        def dispatch_events():
-            """Dispatch trigger events to user-defined handlers"""
-            text = ''
-            while not text.endswith('\n'):
-                text += events_sock.recv(1).decode()
-
-            name, statestr = text.strip().split(':')
-            state = statestr == '1'
+        index = {}
+        names = {name for name, _ in self.trigger_events}
+        names.add(None)
+        for name in names:
+            for state in (True, False):
+                patterns = [(name, state), (name, None)]
+                if name is not None:
+                    patterns += [(None, state), (None, None)]
+                index[name, state] = tuple(
+                    handler
+                    for pattern in patterns
+                    for handler in self.trigger_events.get(pattern, []))
+        self.trigger_index = index
+        return index
+
+    def build_change_index(self):
+        """Return a dict mapping resources keys to a tuple of handlers"""
+        self.change_index = {
+            pattern: tuple(handlers)
+            for pattern, handlers in self.change_events.items()}
+        return self.change_index
+
+    def lookup(self, filepath):
+        """
+        Return the resource held by this HAL that owns the given driver file,
+        or None if there is none
+        """
+        parts = path.relpath(filepath, self.halfs_root).split(path.sep)
+        if len(parts) < 2 or parts[0] not in self.resource_mapping:
+            return None
+        return getattr(self, parts[0], {}).get(parts[1])
 
-            for n in [name, None]:
-                for s in [state, None]:
-                    for handler in self.trigger_events.get((n, s), []):
-                        log.debug(datetime.now(), "CALL", handler.__name__)
-                        r = handler(name, state)
-                        if asyncio.iscoroutine(r):
-                            asyncio.async(r)
+    def tree_changed(self, filepath, created):
+        """
+        Add or remove a resource, when the given driver file is created
+        or deleted
+        """
+        parts = path.relpath(filepath, self.halfs_root).split(path.sep)
+        if len(parts) != 2 or parts[0] not in self.resource_mapping:
+            return
+        collection = getattr(self, parts[0])
+        if created:
+            collection.add(parts[1])
+        else:
+            collection.discard(parts[1])
+            self.invalidate(*parts)
+            if self.fd_cache:
+                # A re-created file is a new inode
+                self.fd_cache.discard_tree(tuple(parts))
+            if self.known_state is not None:
+                self.known_state.pop(tuple(parts), None)
+
+    def add_observer(self, observer):
+        """
+        Register a function called with every batch of dispatched events,
+        before the handlers: observer('triggers', [(name, state), ...]) for
+        trigger events, and observer('changes', [resource, ...]) for changes
+        """
+        self.observers.append(observer)
 
-        # Inotify for changes
-        watcher = InotifyWatch(self.halfs_root)
+    def remove_observer(self, observer):
+        """Unregister an observer"""
+        self.observers.remove(observer)
 
-        def dispatch_changes():
-            """Dispatch filesystem writes to user-defined handlers"""
-            changed_file = watcher.get()
-            resource = self.map_path(changed_file)
-            if not resource:
-                return
-            pattern = type(resource), resource.name
+    def dispatch_triggers(self, events):
+        """
+        Call the handlers registered for each (trigger_name, state) event,
+        and return the number of dispatched events
+        """
+        index = self.trigger_index
+        if index is None:
+            index = self.build_trigger_index()
+        for observer in self.observers:
+            observer('triggers', events)
+
+        for name, state in events:
+            if self.cacheable(('triggers', name)):
+                self.read_cache[('triggers', name)] = {
+                    ((), False): '1' if state else '0'}
+            handlers = index.get((name, state))
+            if handlers is None:
+                handlers = index[None, state]
+            self.metrics.trigger_events[name] += 1
+            for handler in handlers:
+                self.call_handler(handler, name, state)
+        return len(events)
+
+    def resource_state(self, resource):
+        """
+        Return the state of a resource, as a tuple of its resync_properties
+        (None for those that cannot be read)
+        """
+        state = []
+        for prop in self.resync_properties[resource.hal_type]:
+            try:
+                state.append(getattr(resource, prop))
+            except OSError:
+                state.append(None)
+        return tuple(state)
 
-            for handler in self.change_events.get(pattern, []):
-                log.debug(datetime.now(), "CALL", handler.__name__)
-                r = handler(resource)
-                if asyncio.iscoroutine(r):
-                    asyncio.async(r)
+    def read_state(self, resources=None):
+        """
+        Return a list of (resource, state) for the given resources, or for
+        all resynced resources if None (blocking, run in the I/O executor)
+        """
+        if resources is None:
+            resources = [
+                resource
+                for hal_type in self.resync_properties
+                for resource in getattr(self, hal_type, {}).values()]
+        return [(resource, self.resource_state(resource))
+                for resource in resources
+                if resource.hal_type in self.resync_properties]
+
+    @asyncio.coroutine
+    def record_state(self):
+        """
+        Coroutine reading the state of all resources in the I/O executor, so
+        that the first resync only reports the resources that changed since
+        then (see HAL.resync). Called when the loop is installed.
+        """
+        for resource, state in (yield from self.run_io(self.read_state)):
+            # Resources dispatched meanwhile already have a newer state
+            key = resource.hal_type, resource.name
+            self.known_state.setdefault(key, state)
+
+    @asyncio.coroutine
+    def refresh_state(self, resources):
+        """Coroutine reading the state of dispatched resources"""
+        for resource, state in (
+                yield from self.run_io(self.read_state, resources)):
+            self.known_state[resource.hal_type, resource.name] = state
+
+    @asyncio.coroutine
+    def resync(self):
+        """
+        Coroutine re-reading all resources in the I/O executor when inotify
+        events have been lost, and calling the change handlers of those which
+        differ from their known state (recorded when the loop was installed,
+        and refreshed on each change). Return the list of changed resources.
+        """
+        self.read_cache.clear()
+        changed = []
+        for resource, state in (yield from self.run_io(self.read_state)):
+            key = resource.hal_type, resource.name
+            if self.known_state.get(key) != state:
+                self.known_state[key] = state
+                changed.append(resource)
+        log.info("Resync after inotify overflow: %d resources changed",
+                 len(changed))
+        for resource in changed:
+            if getattr(resource, 'uploaded', None):
+                resource.refresh_uploaded()
+        if changed:
+            for observer in self.observers:
+                observer('changes', changed)
+        self.call_change_handlers(changed)
+        return changed
+
+    def dispatch_changes(self, resources):
+        """Call the change handlers once for each given resource"""
+        for resource in resources:
+            self.invalidate(resource.hal_type, resource.name)
+            if getattr(resource, 'uploaded', None):
+                resource.refresh_uploaded()
+        if self.known_state is not None and self.loop is not None:
+            asyncio.async(self.refresh_state(resources), loop=self.loop)
+        for observer in self.observers:
+            observer('changes', resources)
+        self.call_change_handlers(resources)
+
+    def call_change_handlers(self, resources):
+        """Call the change handlers of the given resources"""
+        index = self.change_index
+        if index is None:
+            index = self.build_change_index()
+
+        for resource in resources:
+            self.metrics.change_events[resource.hal_type, resource.name] += 1
+            for handler in index.get((type(resource), resource.name), ()):
+                self.call_handler(handler, resource)
+
+    def call_handler(self, handler, *args):
+        """
+        Call a handler, schedule the coroutine (or future) it returns, and
+        record its latency once it is done
+        """
+        name = handler.__name__
+        log.debug("Call %s", name)
+        self.metrics.handler_calls[name] += 1
+        start = time.monotonic()
+        r = handler(*args)
+        if asyncio.iscoroutine(r) or isinstance(r, asyncio.Future):
+            task = asyncio.async(r, loop=self.loop)
+            task.add_done_callback(partial(self.handler_done, name, start))
+        else:
+            self.metrics.observe_latency(name, time.monotonic() - start)
+
+    def handler_done(self, name, start, task):
+        """
+        Record the latency and the failure of a handler call; dropped calls
+        (cancelled futures) are not counted in the latency
+        """
+        if task.cancelled():
+            return
+        self.metrics.observe_latency(name, time.monotonic() - start)
+        if task.exception() is None:
+            return
+        self.metrics.handler_errors[name] += 1
+        exc = task.exception()
+        log.error("Handler %s failed", name,
+                  exc_info=(type(exc), exc, exc.__traceback__))
 
+    def install_loop(self, loop=None):
+        """
+        Install all callbacks in given asyncio loop
+        (or the default event loop if None)
+        """
         if loop is None:
             loop = asyncio.get_event_loop()
-        loop.add_reader(events_sock, dispatch_events)
-        loop.add_reader(watcher.fd, dispatch_changes)
+        self.use_loop(loop)
+        self.connect_events()
+
+        # Inotify for changes
+        watcher = InotifyWatch(
+            self.halfs_root,
+            mask=self.inotify_mask,
+            resolve=self.lookup,
+            on_tree_change=self.tree_changed)
+        loop.add_reader(watcher.fd, self.read_changes, watcher)
+        self.watcher = watcher
+        self.scheduler.start(loop)
+        if self.known_state is not None:
+            asyncio.async(self.record_state(), loop=loop)
         return loop
 
+    def use_loop(self, loop):
+        """Run handlers (and those already registered) in loop"""
+        self.loop = loop
+        for handler in self.bounded_handlers():
+            handler.loop = loop
+
+    def connect_events(self):
+        """Connect to the events socket, and dispatch its trigger events"""
+        events_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        events_sock.connect(path.join(self.halfs_root, "events"))
+        events_reader = EventsReader()
+
+        def read_events():
+            """Dispatch all pending trigger events to user-defined handlers"""
+            data = events_sock.recv(EVENTS_BUFSIZE)
+            if not data:
+                log.warning("Events socket closed by the driver")
+                self.loop.remove_reader(events_sock)
+                return
+            n = self.dispatch_triggers(events_reader.feed(data))
+            log.debug("%d trigger events dispatched in this wakeup", n)
+
+        self.loop.add_reader(events_sock, read_events)
+        self.events_sock = events_sock
+        return events_sock
+
+    def read_changes(self, watcher):
+        """Dispatch pending filesystem writes to user-defined handlers"""
+        changes = watcher.get_all()
+        if watcher.overflowed:
+            self.changes_overflowed(changes)
+        else:
+            self.dispatch_changes(changes)
+
+    def changes_overflowed(self, changes):
+        """
+        Handle an overflow of the inotify queue, where changes are the ones
+        that were not lost
+        """
+        self.overflows += 1
+        log.warning("Inotify queue overflow (%d so far)", self.overflows)
+        if self.known_state is not None:
+            asyncio.async(self.resync(), loop=self.loop)
+        else:
+            self.dispatch_changes(changes)
+
     def run(self, loop=None):
         """
         Run all registred callbacks in given asyncio loop,
         or the default one if None
         """
-        loop = self.install_loop()
+        loop = self.install_loop(loop)
         loop.run_forever()
 
-    def on_trigger(self, match_name=None, match_state=None):
+    def make_handler(self, func, max_concurrent=None, queue_size=0,
+                     policy='drop-new'):
+        """
+        Return the handler to register for func: a coroutine function, or a
+        BoundedHandler if max_concurrent is given
+        """
+        handler = asyncio.coroutine(func)
+        if max_concurrent is not None:
+            handler = BoundedHandler(handler, max_concurrent, queue_size,
+                                     policy, self.loop)
+        return handler
+
+    def on_trigger(self, match_name=None, match_state=None, **limits):
         """
-        Register a function to be called when a trigger change
+        Register a function to be called when a trigger change. If the
+        max_concurrent keyword is given, at most that many calls of the
+        function run at once; see BoundedHandler for the queue_size and
+        policy keywords.
 
         :Example:
 
@@ -344,18 +1345,191 @@ class HAL(object):
         >>> def log_door_open(*args):
         >>>     "This function is called only when the door opens"
         >>>     print("The door is now open")
+
+        >>> @hal.on_trigger('button', True, max_concurrent=1)
+        >>> def button_pressed(*args):
+        >>>     "Presses are ignored while the light is on"
+        >>>     hal.switchs.light.on = True
+        >>>     yield from asyncio.sleep(5)
+        >>>     hal.switchs.light.on = False
         """
         if match_state is not None:
             match_state = bool(match_state)
         pattern = (match_name, match_state)
 
-        installed = self.trigger_events.get(pattern, [])
+        def wrapper(fun):
+            handlers = self.trigger_events.setdefault(pattern, [])
+            handlers.append(self.make_handler(fun, **limits))
+            self.trigger_index = None
+            return fun
+        return wrapper
 
+    def schedule(self, limits, **job_options):
+        """Return a decorator scheduling a function (see Job)"""
         def wrapper(fun):
-            self.trigger_events[pattern] = installed + [asyncio.coroutine(fun)]
+            handler = self.make_handler(fun, **limits)
+            self.scheduler.add(Job(fun, handler, **job_options))
             return fun
         return wrapper
 
+    def every(self, interval, delay=None, jitter=0, missed='once', **limits):
+        """
+        Register a function to be called every interval seconds, the first
+        time after delay seconds (interval if None). Runs are delayed by a
+        random duration of at most jitter seconds, and missed decides what
+        to do when several runs are late (see halpy.scheduler). Calls may be
+        limited like trigger handlers (see HAL.on_trigger).
+
+        :Example:
+
+        >>> @hal.every(30, jitter=1)
+        >>> def pulse():
+        >>>     hal.switchs.light.on = True
+        >>>     yield from asyncio.sleep(0.5)
+        >>>     hal.switchs.light.on = False
+        """
+        delay = interval if delay is None else delay
+        return self.schedule(limits, delay=delay, interval=interval,
+                             jitter=jitter, missed=missed)
+
+    def at(self, when, jitter=0, **limits):
+        """
+        Register a function to be called every day at a time of day
+        (datetime.time, or string 'HH:MM' or 'HH:MM:SS'), or once at a
+        datetime (at once if it is already passed)
+
+        :Example:
+
+        >>> @hal.at('02:00')
+        >>> def power_off():
+        >>>     hal.switchs.power.on = False
+        """
+        return self.schedule(limits, at=parse_time(when), jitter=jitter)
+
+    def after(self, delay, **limits):
+        """Register a function to be called once, delay seconds from now"""
+        return self.schedule(limits, delay=delay)
+
+    def bounded_handlers(self):
+        """Return all registered handlers that have a concurrency limit"""
+        return [
+            handler
+            for handler in chain(
+                chain.from_iterable(self.trigger_events.values()),
+                chain.from_iterable(self.change_events.values()),
+                (job.handler for job in self.scheduler.jobs))
+            if isinstance(handler, BoundedHandler)]
+
+    def counters(self):
+        """Return the totals of HAL operations that are not dispatch events"""
+        return {
+            'flushed_writes_total': self.flushed_writes,
+            'dropped_writes_total': self.dropped_writes,
+            'skipped_writes_total': self.skipped_writes,
+            'inotify_overflows_total': self.overflows,
+            'missed_runs_total': self.scheduler.missed_runs,
+            'dropped_calls_total': sum(
+                h.dropped for h in self.bounded_handlers()),
+        }
+
+    def stats(self):
+        """
+        Return a dict with the dispatch metrics (see halpy.metrics.Metrics)
+        and the totals of HAL.counters()
+        """
+        stats = self.metrics.as_dict()
+        stats.update(self.counters())
+        return stats
+
+    def prometheus(self):
+        """Return all metrics in the Prometheus text format"""
+        return self.metrics.prometheus(self.counters())
+
+    def dump_metrics(self, filename):
+        """Atomically write the metrics in Prometheus format to filename"""
+        tmp = filename + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.prometheus())
+        os.replace(tmp, filename)
+
+    @asyncio.coroutine
+    def serve_metrics(self, socket_path):
+        """
+        Coroutine starting a UNIX socket server that sends the metrics in
+        Prometheus format to every client, then closes the connection.
+        Return the asyncio Server.
+        """
+        @asyncio.coroutine
+        def send_metrics(reader, writer):
+            writer.write(self.prometheus().encode())
+            yield from writer.drain()
+            writer.close()
+
+        loop = self.loop or asyncio.get_event_loop()
+        return (yield from asyncio.start_unix_server(
+            send_metrics, socket_path, loop=loop))
+
+    def state_properties(self):
+        """
+        Return the list of (resource, property) read to build a snapshot
+        """
+        return [
+            (resource, prop)
+            for hal_type, props in sorted(self.snapshot_properties.items())
+            for name, resource in sorted(getattr(self, hal_type, {}).items())
+            for prop in props
+        ]
+
+    def build_snapshot(self, properties, values):
+        """Return a Snapshot, given the values of the state properties"""
+        state = {hal_type: {} for hal_type in self.snapshot_properties}
+        for (resource, prop), value in zip(properties, values):
+            resources = state[resource.hal_type]
+            if len(self.snapshot_properties[resource.hal_type]) == 1:
+                resources[resource.name] = value
+            else:
+                resources.setdefault(resource.name, {})[prop] = value
+        for hal_type, resources in state.items():
+            state[hal_type] = MappingProxyType({
+                name: MappingProxyType(v) if isinstance(v, dict) else v
+                for name, v in resources.items()})
+        return Snapshot(state, time.time())
+
+    def snapshot(self):
+        """
+        Read the state of all resources in one pass, with reads running
+        concurrently in the I/O executor, and return it as a Snapshot
+        """
+        properties = self.state_properties()
+        values = self.executor.map(lambda p: getattr(*p), properties)
+        return self.build_snapshot(properties, list(values))
+
+    @asyncio.coroutine
+    def asnapshot(self):
+        """Coroutine version of snapshot"""
+        loop = self.loop or asyncio.get_event_loop()
+        properties = self.state_properties()
+        values = yield from asyncio.gather(
+            *[self.run_io(getattr, *p) for p in properties], loop=loop)
+        return self.build_snapshot(properties, values)
+
+    def sample_sensors(self, rate_hz, window, sensors=None, loop=None):
+        """
+        Start reading the given sensors (all by default) rate_hz times per
+        second, in a single poller. The last `window` samples are kept in a
+        NumPy array; see halpy.sampling.SensorSampler. Requires NumPy.
+
+        :Example:
+
+        >>> sampler = hal.sample_sensors(10, 50)
+        >>> print(sampler.as_dict(sampler.mean()))
+        >>> for block in sampler.blocks(10):  # in a coroutine, with async
+        >>>     print(block.max(axis=0))
+        """
+        from .sampling import SensorSampler
+        loop = loop or self.loop or asyncio.get_event_loop()
+        return SensorSampler(self, rate_hz, window, sensors, loop).start()
+
     @property
     def rx_bytes(self):
         """
@@ -0,0 +1,129 @@
+"""Dispatch counters and latency histograms, with a Prometheus text export"""
+
+from bisect import bisect_left
+from collections import Counter
+
+# Upper bounds (in seconds) of the handler latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+
+class Histogram(object):
+    """Count observed values in fixed buckets"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # The last count is for values above the greatest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        """Add a value to the histogram"""
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """Return a list of (upper_bound, count of values <= upper_bound)"""
+        res, total = [], 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            res.append((bound, total))
+        return res
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': self.cumulative(),
+        }
+
+
+def format_labels(**labels):
+    """Format labels for the Prometheus text format"""
+    return ','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', r'\\').replace('"', r'\"'))
+        for k, v in sorted(labels.items()))
+
+
+def format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(float(bound))
+
+
+class Metrics(object):
+    """
+    The counters maintained by a HAL object while dispatching events:
+    trigger events per trigger, change events per resource, handler calls
+    and errors, and handler latency (from call to completion) histograms.
+    """
+
+    def __init__(self):
+        self.trigger_events = Counter()
+        self.change_events = Counter()
+        self.handler_calls = Counter()
+        self.handler_errors = Counter()
+        self.handler_latency = {}
+
+    def observe_latency(self, handler_name, seconds):
+        """Record the time taken by a handler call"""
+        histogram = self.handler_latency.get(handler_name)
+        if histogram is None:
+            histogram = self.handler_latency[handler_name] = Histogram()
+        histogram.observe(seconds)
+
+    def as_dict(self):
+        """Return all metrics as a dict of plain Python objects"""
+        return {
+            'trigger_events': dict(self.trigger_events),
+            'change_events': {
+                '/'.join(key): n for key, n in self.change_events.items()},
+            'handler_calls': dict(self.handler_calls),
+            'handler_errors': dict(self.handler_errors),
+            'handler_latency': {
+                name: h.as_dict() for name, h in self.handler_latency.items()},
+        }
+
+    def prometheus(self, counters=None, prefix='halpy'):
+        """
+        Return the metrics in the Prometheus text exposition format.
+        counters is an optional dict of additional {name: total} counters.
+        """
+        lines = []
+
+        def counter(name, description, values):
+            lines.append('# HELP {}_{} {}'.format(prefix, name, description))
+            lines.append('# TYPE {}_{} counter'.format(prefix, name))
+            for labels, value in values:
+                lines.append('{}_{}{{{}}} {}'.format(
+                    prefix, name, format_labels(**labels), value))
+
+        counter('trigger_events_total', "Trigger events received", [
+            ({'trigger': name}, n)
+            for name, n in sorted(self.trigger_events.items())])
+        counter('change_events_total', "Change events dispatched", [
+            ({'type': key[0], 'resource': key[1]}, n)
+            for key, n in sorted(self.change_events.items())])
+        counter('handler_calls_total', "Handler calls", [
+            ({'handler': name}, n)
+            for name, n in sorted(self.handler_calls.items())])
+        counter('handler_errors_total', "Handler calls that failed", [
+            ({'handler': name}, n)
+            for name, n in sorted(self.handler_errors.items())])
+
+        name = prefix + '_handler_latency_seconds'
+        lines.append('# HELP {} Handler latency, from call to end'.format(
+            name))
+        lines.append('# TYPE {} histogram'.format(name))
+        for handler, histogram in sorted(self.handler_latency.items()):
+            for bound, n in histogram.cumulative():
+                labels = format_labels(handler=handler, le=format_bound(bound))
+                lines.append('{}_bucket{{{}}} {}'.format(name, labels, n))
+            labels = format_labels(handler=handler)
+            lines.append('{}_sum{{{}}} {}'.format(name, labels, histogram.sum))
+            lines.append('{}_count{{{}}} {}'.format(
+                name, labels, histogram.count))
+
+        for name, value in sorted((counters or {}).items()):
+            lines.append('# TYPE {}_{} counter'.format(prefix, name))
+            lines.append('{}_{} {}'.format(prefix, name, value))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,186 @@
+"""Fixed rate sampling of HAL sensors (requires NumPy)"""
+
+import asyncio
+import numpy as np
+from logging import getLogger
+
+log = getLogger(__name__)
+
+
+class SensorSampler(object):
+    """
+    Periodically read a set of sensors, keeping the last `window` samples in
+    a preallocated ring buffer, with one column per sensor. You shouldn't
+    instanciate a sampler by yourself (see HAL.sample_sensors)
+    """
+
+    def __init__(self, hal, rate_hz, window, sensors=None, loop=None):
+        self.hal = hal
+        self.period = 1.0 / rate_hz
+        self.window = window
+        self.sensors = sorted(hal.sensors if sensors is None else sensors)
+        self.buffer = np.zeros((window, len(self.sensors)))
+        self.times = np.zeros(window)
+        # Total number of samples taken since start
+        self.count = 0
+        self.loop = loop or asyncio.get_event_loop()
+        self.waiters = []
+        self.task = None
+        # The exception that stopped the sampling, if any
+        self.error = None
+
+    def start(self):
+        """Start sampling in the loop"""
+        if self.task is None:
+            self.task = asyncio.async(self.run(), loop=self.loop)
+        return self
+
+    def stop(self):
+        """Stop sampling"""
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def read_all(self):
+        """
+        Return the actual value of all sampled sensors; sensors that cannot
+        be read are NaN in this sample
+        """
+        values = []
+        for name in self.sensors:
+            try:
+                values.append(self.hal.sensors[name].value)
+            except (OSError, ValueError) as err:
+                log.warning("Unable to sample sensor %s: %s", name, err)
+                values.append(np.nan)
+        return values
+
+    @asyncio.coroutine
+    def run(self):
+        """
+        Sampling loop, on absolute deadlines; late samples are skipped. If
+        sampling fails, the error is raised in the waiting consumers.
+        """
+        deadline = self.loop.time()
+        try:
+            while True:
+                values = yield from self.hal.run_io(self.read_all)
+                self.push(values, self.loop.time())
+                deadline += self.period
+                now = self.loop.time()
+                if deadline < now:
+                    deadline += self.period * (
+                        (now - deadline) // self.period + 1)
+                yield from asyncio.sleep(deadline - now, loop=self.loop)
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            log.error("Sampling stopped", exc_info=True)
+            self.error = err
+            waiters, self.waiters = self.waiters, []
+            for future in waiters:
+                if not future.done():
+                    future.set_exception(err)
+
+    def push(self, values, timestamp):
+        """Append a row of sensor values to the ring buffer"""
+        i = self.count % self.window
+        self.buffer[i] = values
+        self.times[i] = timestamp
+        self.count += 1
+        waiters, self.waiters = self.waiters, []
+        for future in waiters:
+            if not future.done():
+                future.set_result(None)
+
+    @asyncio.coroutine
+    def wait(self):
+        """
+        Coroutine returning when the next sample is taken, or raising the
+        error that stopped the sampling
+        """
+        if self.error is not None:
+            raise self.error
+        future = asyncio.Future(loop=self.loop)
+        self.waiters.append(future)
+        yield from future
+
+    def rows(self, start, stop):
+        """
+        Return the samples number start to stop (excluded) as an array of
+        shape (stop - start, len(self.sensors)); they must be in the window
+        """
+        assert self.count - self.window <= start <= stop <= self.count
+        return self.buffer[np.arange(start, stop) % self.window]
+
+    @property
+    def valid(self):
+        """The filled part of the ring buffer, in storage order"""
+        return self.buffer[:min(self.count, self.window)]
+
+    def samples(self):
+        """Return the samples in the window, oldest first"""
+        return self.rows(max(0, self.count - self.window), self.count)
+
+    def mean(self):
+        """Return the mean value of each sensor over the window"""
+        return self.valid.mean(axis=0)
+
+    def min(self):
+        """Return the minimal value of each sensor over the window"""
+        return self.valid.min(axis=0)
+
+    def max(self):
+        """Return the maximal value of each sensor over the window"""
+        return self.valid.max(axis=0)
+
+    def ema(self, alpha):
+        """
+        Return the exponential moving average of each sensor over the window,
+        where the weight of a sample is multiplied by (1 - alpha) for each
+        newer sample
+        """
+        samples = self.samples()
+        weights = (1 - alpha) ** np.arange(len(samples))[::-1]
+        return weights.dot(samples) / weights.sum()
+
+    def as_dict(self, values):
+        """Map the sensors names to a row of values, eg. sampler.mean()"""
+        return dict(zip(self.sensors, values))
+
+    def blocks(self, size):
+        """
+        Return an asynchronous iterator over blocks of `size` consecutive
+        samples taken from now on
+        """
+        return SampleStream(self, size)
+
+    def __aiter__(self):
+        return self.blocks(1)
+
+
+class SampleStream(object):
+    """
+    Asynchronous iterator over blocks of samples from a SensorSampler.
+    If the consumer is too slow and samples leave the window before being
+    read, the stream skips to the most recent block.
+    """
+
+    def __init__(self, sampler, size):
+        assert 0 < size <= sampler.window
+        self.sampler = sampler
+        self.size = size
+        self.position = sampler.count
+
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __anext__(self):
+        sampler = self.sampler
+        while sampler.count < self.position + self.size:
+            yield from sampler.wait()
+        if sampler.count - self.position > sampler.window:
+            self.position = sampler.count - self.size
+        start, self.position = self.position, self.position + self.size
+        return sampler.rows(start, self.position)
@@ -0,0 +1,193 @@
+"""
+Timed jobs for a HAL object. All jobs are kept in one heap, ordered by
+their next run time, and a single loop timer is armed for the earliest one;
+hundreds of periodic jobs hence cost one timer. Due jobs are called through
+the same dispatch path as trigger and change handlers (see HAL.every,
+HAL.at and HAL.after).
+"""
+
+from datetime import datetime, time, timedelta
+from heapq import heappush, heappop
+from itertools import count
+import random
+import time as clock
+
+# What to do when the loop was so late that several runs of a periodic job
+# are due at once:
+#  - 'once': call the job once for all of them
+#  - 'all': call the job once for each of them
+#  - 'skip': don't call the job, and wait for its next run
+MISSED_POLICIES = ('once', 'all', 'skip')
+
+# The loop may run timers up to its clock resolution in advance
+CLOCK_RESOLUTION = clock.get_clock_info('monotonic').resolution
+
+
+def parse_time(when):
+    """
+    Return a datetime.time from a string 'HH:MM' or 'HH:MM:SS'; times and
+    datetimes are returned unchanged
+    """
+    if isinstance(when, (time, datetime)):
+        return when
+    parts = [int(x) for x in when.split(':')]
+    if not 2 <= len(parts) <= 3:
+        raise ValueError("Invalid time of day {}".format(when))
+    return time(*parts)
+
+
+def seconds_until(time_of_day, now=None):
+    """Return the number of seconds to the next given time of day"""
+    now = now or datetime.now(time_of_day.tzinfo)
+    target = datetime.combine(now.date(), time_of_day)
+    if target <= now:
+        target += timedelta(days=1)
+    return (target - now).total_seconds()
+
+
+class Job(object):
+    """
+    A function scheduled by a Scheduler. The job runs once after delay
+    seconds, once at a given datetime, every interval seconds (after delay
+    seconds), or every day at a given time of day. If jitter is given, each
+    run is delayed by a random duration in [0, jitter] seconds, without
+    moving the following runs.
+    """
+
+    def __init__(self, func, handler, delay=0, interval=None, at=None,
+                 jitter=0, missed='once'):
+        if missed not in MISSED_POLICIES:
+            raise ValueError("Unknown missed runs policy {}".format(missed))
+        if interval is not None and not 0 <= jitter < interval:
+            raise ValueError("The jitter must be smaller than the interval")
+        self.func = func
+        self.handler = handler
+        self.delay = delay
+        self.interval = interval
+        self.at = at
+        self.jitter = jitter
+        self.missed_policy = missed
+        self.deadline = None
+        self.cancelled = False
+        self.runs = 0
+        self.missed = 0
+
+    @property
+    def daily(self):
+        return isinstance(self.at, time)
+
+    def first_deadline(self, now):
+        """Return the first run time, given the current loop time"""
+        if self.daily:
+            return now + seconds_until(self.at)
+        if self.at is not None:
+            late = datetime.now(self.at.tzinfo) - self.at
+            return now - min(0, late.total_seconds())
+        return now + self.delay
+
+    def due_runs(self, now):
+        """
+        Return how many times the job should be called now that its deadline
+        is passed, and set its next deadline (None if the job is over)
+        """
+        if self.daily:
+            # Computed from the wall clock, which may drift from the loop one
+            later = datetime.now(self.at.tzinfo) + timedelta(seconds=1)
+            self.deadline = now + 1 + seconds_until(self.at, later)
+            return 1
+        if self.interval is None:
+            self.deadline = None
+            return 1
+
+        late = max(0, int((now - self.deadline) // self.interval))
+        self.deadline += (late + 1) * self.interval
+        self.missed += late
+        if late == 0 or self.missed_policy == 'once':
+            return 1
+        return late + 1 if self.missed_policy == 'all' else 0
+
+
+class Scheduler(object):
+    """
+    A heap of jobs, whose due runs are given to call (a function taking a
+    handler). Jobs may be added before the scheduler is started in a loop.
+    """
+
+    def __init__(self, call):
+        self.call = call
+        self.jobs = []
+        self.heap = []
+        self.sequence = count()
+        self.loop = None
+        self.handle = None
+        self.missed_runs = 0
+
+    def add(self, job):
+        """Schedule a job, return it"""
+        self.jobs.append(job)
+        if self.loop is not None:
+            job.deadline = job.first_deadline(self.loop.time())
+            self.push(job)
+            if self.heap[0][2] is job:
+                self.rearm()
+        return job
+
+    def remove(self, func):
+        """Cancel all jobs calling func"""
+        for job in self.jobs:
+            if job.func is func:
+                job.cancelled = True
+        self.jobs = [job for job in self.jobs if not job.cancelled]
+
+    def push(self, job):
+        when = job.deadline
+        if job.jitter:
+            when += random.uniform(0, job.jitter)
+        heappush(self.heap, (when, next(self.sequence), job))
+
+    def start(self, loop):
+        """Start running the jobs in loop"""
+        self.loop = loop
+        self.heap = []
+        now = loop.time()
+        for job in self.jobs:
+            job.deadline = job.first_deadline(now)
+            self.push(job)
+        self.rearm()
+
+    def stop(self):
+        """Stop running the jobs"""
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        self.loop = None
+
+    def rearm(self):
+        """Arm the loop timer for the earliest job"""
+        while self.heap and self.heap[0][2].cancelled:
+            heappop(self.heap)
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        if self.heap:
+            self.handle = self.loop.call_at(self.heap[0][0], self.wakeup)
+
+    def wakeup(self):
+        """Call all due jobs, then rearm the timer"""
+        self.handle = None
+        now = self.loop.time()
+        while self.heap and self.heap[0][0] <= now + CLOCK_RESOLUTION:
+            _, _, job = heappop(self.heap)
+            if job.cancelled:
+                continue
+            missed = job.missed
+            runs = job.due_runs(now)
+            job.runs += runs
+            self.missed_runs += job.missed - missed
+            for i in range(runs):
+                self.call(job.handler)
+            if job.deadline is None:
+                self.jobs.remove(job)
+            else:
+                self.push(job)
+        self.rearm()
@@ -0,0 +1,57 @@
+"""
+Play sequences of frames longer than one animation buffer (255 frames), by
+uploading them chunk after chunk, each one just when the previous one has
+been played. Frames are consumed lazily, so that tunes of any length are
+played in constant memory.
+
+:Example:
+
+>>> tune = Partition(Note(440), Note(494), ...)
+>>> loop.run_until_complete(play_partition(hal.animations.buzzer, tune))
+"""
+
+import asyncio
+from .generators import chunks
+
+
+@asyncio.coroutine
+def play_frames(animation, frames, fps=None, chunk_size=255, loop=None):
+    """
+    Coroutine playing an iterable of frames on animation, at fps (or at the
+    current animation speed if None). Chunks are uploaded on deadlines
+    computed from the start time with the loop clock, so that the timing
+    does not drift. The animation is stopped if the coroutine is cancelled.
+    Return the number of played frames.
+    """
+    loop = loop or animation.hal.loop or asyncio.get_event_loop()
+    if fps is None:
+        fps = int(animation.fps)
+    else:
+        animation.fps = fps
+    animation.looping = False
+
+    sent = 0
+    start = loop.time()
+    try:
+        for chunk in chunks(frames, chunk_size):
+            delay = start + sent / fps - loop.time()
+            if delay > 0:
+                yield from asyncio.sleep(delay, loop=loop)
+            animation.frames = chunk
+            animation.playing = True
+            sent += len(chunk)
+        delay = start + sent / fps - loop.time()
+        if delay > 0:
+            yield from asyncio.sleep(delay, loop=loop)
+    except asyncio.CancelledError:
+        animation.playing = False
+        raise
+    return sent
+
+
+@asyncio.coroutine
+def play_partition(animation, partition, base_duration=4, fps=None,
+                   loop=None):
+    """Coroutine playing a Partition on animation (see play_frames)"""
+    return (yield from play_frames(
+        animation, partition.iter_frames(base_duration), fps, loop=loop))
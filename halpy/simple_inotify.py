@@ -1,45 +1,162 @@
 import ctypes as C
 import os
-from struct import unpack
-from collections import namedtuple
+from struct import Struct
+from collections import namedtuple, deque
 
 
 libc = C.CDLL("libc.so.6")
+IN_MODIFY = 0x02
 IN_CLOSE_WRITE = 0x08  # Better: parse sys/inotify.h
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+
+# Events signaling that an entry appeared or disappeared in a directory
+IN_TREE = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+
+# Size of the buffer used to drain the inotify queue in a single read
+READ_BUFSIZE = 64 * 1024
 
 
 class SimpleINotifyError(Exception):
     pass
 
 
-struct_inotify_event = namedtuple('inotify_event', 'wd mask cookie len')
+inotify_event_header = Struct('iIII')
+inotify_event = namedtuple('inotify_event', 'wd mask cookie name')
 
 
 class InotifyWatch(object):
-    def __init__(self, directory):
+    def __init__(self, directory, mask=IN_CLOSE_WRITE, resolve=None,
+                 on_tree_change=None):
+        """
+        Watch all files under directory for the events in mask, with one
+        watch per directory. If given, resolve is called once on each file
+        path, and its result is returned by get_all instead of the path;
+        files it resolves to None are ignored. Files and directories created
+        later are watched too; if given, on_tree_change(path, created) is
+        called when an entry is created or deleted.
+        """
+        self.mask = mask
+        # Number of times the kernel queue overflowed, and whether it
+        # happened during the last get_all
+        self.overflows = 0
+        self.overflowed = False
+        self.pending = deque()
         self.followed = {}
+        self.targets = {}
+        self.resolve = resolve
+        self.on_tree_change = on_tree_change
         self.fd = libc.inotify_init()
         if self.fd < 0:
             raise SimpleINotifyError("Unable to initialize inotify")
+        self.watch_tree(directory)
+
+    def add_watch(self, full_path, mask):
+        """Watch full_path for given events, return the watch descriptor"""
+        r = libc.inotify_add_watch(
+            self.fd,
+            C.c_char_p(bytes(full_path.encode())),
+            C.c_int(mask))
+        if r < 0:
+            raise SimpleINotifyError("Unable to follow %s: %d" % (
+                full_path, r))
+        self.followed[r] = full_path
+        return r
 
+    def add_target(self, wd, name):
+        """Resolve the file name in the directory watched by wd"""
+        full_path = os.path.join(self.followed[wd], name)
+        target = self.resolve(full_path) if self.resolve else full_path
+        self.targets[wd, name] = target
+        return target
+
+    def watch_tree(self, directory):
+        """Watch directory and all its descendants"""
         for root, dirs, files in os.walk(directory):
+            wd = self.add_watch(root, self.mask | IN_TREE)
             for f in files:
-                full_path = os.path.join(root, f)
-
-                r = libc.inotify_add_watch(
-                    self.fd,
-                    C.c_char_p(bytes(full_path.encode())),
-                    C.c_int(IN_CLOSE_WRITE))
-                if r < 0:
-                    raise SimpleINotifyError("Unable to follow %s: %d" % (
-                        full_path, r))
-                self.followed[r] = full_path
+                self.add_target(wd, f)
 
     def get(self):
-        buf = os.read(self.fd, 16)
-        if len(buf) == 16:
-            event = struct_inotify_event._make(unpack('iIII', buf))
-            # Read name length bytes
-            if event.len > 0:
-                os.read(self.fd, event.len)
-            return self.followed[event.wd]
+        """Return the next written file (or its target), wait if none"""
+        while not self.pending:
+            self.pending.extend(self.get_all())
+        return self.pending.popleft()
+
+    def read_events(self):
+        """Read all pending events at once, return a list of inotify_event"""
+        buf = os.read(self.fd, READ_BUFSIZE)
+        events = []
+        offset = 0
+        while offset + inotify_event_header.size <= len(buf):
+            wd, mask, cookie, length = inotify_event_header.unpack_from(
+                buf, offset)
+            offset += inotify_event_header.size
+            # The name is padded with null bytes
+            name = buf[offset:offset + length].rstrip(b'\0').decode()
+            offset += length
+            events.append(inotify_event(wd, mask, cookie, name))
+        return events
+
+    def get_all(self):
+        """
+        Return the list of files (or their resolved targets) written since
+        the last read, in order of first write. A target written several
+        times is listed only once. If the kernel queue overflowed, some
+        writes are missing, and self.overflowed is set to True.
+        """
+        changed, seen = [], set()
+        self.overflowed = False
+        for event in self.read_events():
+            if event.mask & IN_Q_OVERFLOW:
+                # Events were lost, the caller should check everything
+                self.overflows += 1
+                self.overflowed = True
+                continue
+            if event.mask & IN_IGNORED:
+                self.forget(event.wd)
+                continue
+            if event.mask & IN_TREE:
+                self.tree_changed(event)
+                continue
+            key = event.wd, event.name
+            if key in self.targets:
+                target = self.targets[key]
+            elif event.wd in self.followed:
+                target = self.add_target(*key)
+            else:
+                continue
+            if target is not None and target not in seen:
+                seen.add(target)
+                changed.append(target)
+        return changed
+
+    def tree_changed(self, event):
+        """Handle the creation or deletion of a directory entry"""
+        directory = self.followed.get(event.wd)
+        if directory is None:
+            return
+        full_path = os.path.join(directory, event.name)
+        created = bool(event.mask & (IN_CREATE | IN_MOVED_TO))
+        if self.on_tree_change:
+            self.on_tree_change(full_path, created)
+        if not created:
+            self.targets.pop((event.wd, event.name), None)
+        elif event.mask & IN_ISDIR:
+            self.watch_tree(full_path)
+        else:
+            self.add_target(event.wd, event.name)
+
+    def forget(self, wd):
+        """Drop a watch removed by the kernel (its directory was deleted)"""
+        self.followed.pop(wd, None)
+        for key in [k for k in self.targets if k[0] == wd]:
+            del self.targets[key]
+
+    def __iter__(self):
+        return iter(self.get_all())
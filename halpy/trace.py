@@ -0,0 +1,120 @@
+"""
+Record the events dispatched by a HAL object to a trace file, and replay
+them later through the same dispatch code paths.
+
+A trace is a text file (gzipped if its name ends with .gz) with one event
+per line, made of tab-separated fields:
+
+    <seconds since start>  T  <trigger name>  <0|1>
+    <seconds since start>  C  <resource type>  <resource name>
+
+Events of the same batch (read at once from the events socket or from
+inotify) have the same timestamp.
+
+:Example:
+
+>>> with TraceRecorder(hal, 'friday.trace.gz'):
+>>>     hal.run()
+
+>>> loop.run_until_complete(replay(hal, 'friday.trace.gz', speed=10))
+"""
+
+import asyncio
+import gzip
+from itertools import groupby
+
+
+def open_trace(filename, mode):
+    """Open a trace file in text mode, gzipped if filename ends with .gz"""
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode + 't')
+    return open(filename, mode)
+
+
+class TraceRecorder(object):
+    """Write all events dispatched by a HAL object to a trace file"""
+
+    def __init__(self, hal, filename, loop=None):
+        self.hal = hal
+        self.filename = filename
+        self.loop = loop
+        self.file = None
+        self.start_time = None
+        self.recorded = 0
+
+    def start(self):
+        """Start recording"""
+        self.loop = self.loop or self.hal.loop or asyncio.get_event_loop()
+        self.file = open_trace(self.filename, 'w')
+        self.start_time = self.loop.time()
+        self.hal.add_observer(self.record)
+        return self
+
+    def stop(self):
+        """Stop recording and close the trace file"""
+        self.hal.remove_observer(self.record)
+        self.file.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def record(self, kind, items):
+        """Observer of the HAL dispatch (see HAL.add_observer)"""
+        t = '%.6f' % (self.loop.time() - self.start_time)
+        if kind == 'triggers':
+            lines = ['%s\tT\t%s\t%d\n' % (t, name, state)
+                     for name, state in items]
+        else:
+            lines = ['%s\tC\t%s\t%s\n' % (t, r.hal_type, r.name)
+                     for r in items]
+        self.file.writelines(lines)
+        self.recorded += len(lines)
+
+
+def read_trace(filename):
+    """
+    Return a list of batches (timestamp, kind, items), where kind and items
+    are like the arguments of HAL observers, except that changed resources
+    are given as (hal_type, name) pairs.
+    """
+    with open_trace(filename, 'r') as f:
+        rows = [line.rstrip('\n').split('\t') for line in f if line.strip()]
+
+    batches = []
+    for (t, code), group in groupby(rows, key=lambda row: tuple(row[:2])):
+        if code == 'T':
+            batches.append((float(t), 'triggers', [
+                (name, state == '1') for _, _, name, state in group]))
+        else:
+            batches.append((float(t), 'changes', [
+                (hal_type, name) for _, _, hal_type, name in group]))
+    return batches
+
+
+@asyncio.coroutine
+def replay(hal, filename, speed=1.0, loop=None):
+    """
+    Coroutine dispatching the events of a trace to the handlers of hal, as
+    HAL.install_loop does for live events. The original timing is kept,
+    accelerated speed times, or the events are dispatched as fast as
+    possible if speed is None. Return the number of replayed events.
+    """
+    loop = loop or hal.loop or asyncio.get_event_loop()
+    start = loop.time()
+    replayed = 0
+    for t, kind, items in read_trace(filename):
+        delay = 0 if speed is None else start + t / speed - loop.time()
+        yield from asyncio.sleep(max(0, delay), loop=loop)
+        if kind == 'triggers':
+            replayed += hal.dispatch_triggers(items)
+            continue
+        resources = [
+            getattr(hal, hal_type)[name]
+            for hal_type, name in items
+            if name in getattr(hal, hal_type, {})]
+        hal.dispatch_changes(resources)
+        replayed += len(resources)
+    return replayed
@@ -0,0 +1,137 @@
+"""
+Vectorized waveforms for Animation frames (requires NumPy). All functions
+return read-only arrays of unsigned bytes, that can be given directly to
+Animation.frames. Results are memoized, so that asking several times for
+the same waveform is free.
+
+Like in halpy.generators, val_min and val_max are either integers in
+[0, 255] or floats in [0, 1].
+
+:Example:
+
+>>> anim.frames = sine(100, 0.2, 1.0)
+>>> anim.frames = crossfade(sine(64), square(64))
+"""
+
+from functools import lru_cache
+import numpy as np
+
+CACHE_SIZE = 256
+
+
+def byte_range(val_min, val_max):
+    """Return (val_min, val_max) as numbers in [0, 255]"""
+    if isinstance(val_min, float):
+        val_min = 255 * val_min
+    if isinstance(val_max, float):
+        val_max = 255 * val_max
+    assert 0 <= val_min <= val_max <= 255
+    return val_min, val_max
+
+
+def scale(curve, val_min, val_max):
+    """
+    Map a curve with values in [0, 1] to read-only frames varying between
+    val_min and val_max
+    """
+    val_min, val_max = byte_range(val_min, val_max)
+    frames = (val_min + (val_max - val_min) * curve).astype(np.uint8)
+    frames.flags.writeable = False
+    return frames
+
+
+def phases(n_frames):
+    """Return the position of each frame in the period, in [0, 1["""
+    assert 0 < n_frames < 256
+    return np.arange(n_frames) / n_frames
+
+
+@lru_cache(CACHE_SIZE, typed=True)
+def sine(n_frames=255, val_min=0, val_max=255):
+    """One sine period, starting at the middle value and going up"""
+    return scale((1 + np.sin(2 * np.pi * phases(n_frames))) / 2,
+                 val_min, val_max)
+
+
+@lru_cache(CACHE_SIZE, typed=True)
+def triangle(n_frames=255, val_min=0, val_max=255):
+    """One triangle period, going from val_min to val_max and back"""
+    return scale(1 - np.abs(2 * phases(n_frames) - 1), val_min, val_max)
+
+
+@lru_cache(CACHE_SIZE, typed=True)
+def sawtooth(n_frames=255, val_min=0, val_max=255):
+    """A linear ramp from val_min to val_max"""
+    assert 0 < n_frames < 256
+    return scale(np.linspace(0, 1, n_frames), val_min, val_max)
+
+
+@lru_cache(CACHE_SIZE, typed=True)
+def square(n_frames=255, val_min=0, val_max=255, duty=0.5):
+    """val_max for the first duty fraction of the period, then val_min"""
+    return scale((phases(n_frames) < duty).astype(float), val_min, val_max)
+
+
+@lru_cache(CACHE_SIZE, typed=True)
+def exponential(n_frames=255, val_min=0, val_max=255, rate=5.0):
+    """
+    An exponential ease from val_min to val_max; a positive rate starts
+    slowly (ease-in), a negative rate starts fast (ease-out)
+    """
+    assert 0 < n_frames < 256 and rate != 0
+    t = np.linspace(0, 1, n_frames)
+    return scale(np.expm1(rate * t) / np.expm1(rate), val_min, val_max)
+
+
+@lru_cache(CACHE_SIZE, typed=True)
+def gamma(n_frames=255, val_min=0, val_max=255, gamma=2.2):
+    """
+    A ramp from val_min to val_max corrected by gamma, eg. to make a led
+    brightness look linear to the human eye
+    """
+    assert 0 < n_frames < 256 and gamma > 0
+    return scale(np.linspace(0, 1, n_frames) ** gamma, val_min, val_max)
+
+
+@lru_cache(CACHE_SIZE, typed=True)
+def adsr(attack, decay, sustain, release, sustain_level=0.5,
+         val_min=0, val_max=255):
+    """
+    An ADSR envelope: a linear rise to val_max in `attack` frames, a linear
+    decay to the sustain level (a fraction of the range) in `decay` frames,
+    held for `sustain` frames, then a linear release to val_min in `release`
+    frames
+    """
+    assert 0 <= sustain_level <= 1
+    assert 0 < attack + decay + sustain + release < 256
+    curve = np.concatenate([
+        np.linspace(0, 1, attack, endpoint=False),
+        np.linspace(1, sustain_level, decay, endpoint=False),
+        np.full(sustain, sustain_level),
+        np.linspace(sustain_level, 0, release),
+    ])
+    return scale(curve, val_min, val_max)
+
+
+def crossfade(frames_from, frames_to):
+    """
+    Linearly fade from a sequence of frames to another one of the same
+    length: the first frame is frames_from[0] and the last is frames_to[-1]
+    """
+    return cached_crossfade(tuple(frames_from), tuple(frames_to))
+
+
+@lru_cache(CACHE_SIZE, typed=True)
+def cached_crossfade(frames_from, frames_to):
+    assert len(frames_from) == len(frames_to)
+    a = np.array(frames_from, dtype=float)
+    b = np.array(frames_to, dtype=float)
+    t = np.linspace(0, 1, len(a))
+    return scale(((1 - t) * a + t * b) / 255, 0, 255)
+
+
+def cache_clear():
+    """Empty the memoized waveforms"""
+    for func in (sine, triangle, sawtooth, square, exponential, gamma, adsr,
+                 cached_crossfade):
+        func.cache_clear()
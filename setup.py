@@ -14,6 +14,10 @@ setup(
 
     # Put package dependencies here (list of strings)
     install_requires=[],
+    extras_require={
+        # Sensor sampling (halpy.sampling) and waveforms (halpy.waveforms)
+        'numpy': ['numpy'],
+    },
     zip_safe=False,
 
     # Put here command line scripts (usually located in bin/; list of strings)
@@ -0,0 +1,17 @@
+from benchmarks.__main__ import run
+from benchmarks.scenarios import SCENARIOS, percentile
+from os import path
+
+ROOT = path.join('/tmp', 'halbenchtest')
+
+
+def test_percentile():
+    assert percentile([3, 1, 2, 4], 50) == 3
+    assert percentile([3, 1, 2, 4], 99) == 4
+
+
+def test_quick_run():
+    report = run(sorted(SCENARIOS), ROOT, quick=True)
+    assert [s['scenario'] for s in report['scenarios']] == sorted(SCENARIOS)
+    assert all(s['results'] for s in report['scenarios'])
+    assert not path.exists(ROOT)
@@ -0,0 +1,107 @@
+from benchmarks.fakedriver import FakeDriver
+from halpy import HAL
+from halpy.cluster import HALCluster
+import asyncio
+import pytest
+from os import path
+
+ROOT = path.join('/tmp', 'clustertest')
+
+
+def make_cluster(loop):
+    drivers = [FakeDriver(path.join(ROOT, name), n=2, loop=loop)
+               for name in ('back', 'front')]
+    for driver in drivers:
+        loop.run_until_complete(driver.start())
+    cluster = HALCluster({
+        'front': path.join(ROOT, 'front'),
+        'back': path.join(ROOT, 'back'),
+    })
+    return drivers, cluster
+
+
+def run_until(loop, condition, timeout=1):
+    start = loop.time()
+    while not condition() and loop.time() - start < timeout:
+        loop.run_until_complete(asyncio.sleep(0.005, loop=loop))
+
+
+def test_cluster():
+    loop = asyncio.new_event_loop()
+    (back, front), cluster = make_cluster(loop)
+    triggers, changes = [], []
+
+    @cluster.on_trigger('trigger0', device='front')
+    def front_trigger(name, state):
+        triggers.append(('front', name, state))
+
+    @cluster.on_trigger('trigger0')
+    def any_trigger(name, state):
+        triggers.append(('any', name, state))
+
+    @cluster.on_change('switchs', 'switch1')
+    def switch_changed(switch):
+        changes.append((switch.hal is cluster['back'], switch.name))
+
+    for device in ('front', None):
+        with pytest.raises(KeyError):
+            cluster.on_change('switchs', 'swtich1', device=device)
+
+    try:
+        cluster.install_loop(loop)
+        assert list(cluster) == ['back', 'front'] and len(cluster) == 2
+        assert cluster.lookup(path.join(ROOT, 'back', 'switchs', 'switch1')) \
+            is cluster['back'].switchs['switch1']
+        loop.run_until_complete(front.wait_clients())
+        loop.run_until_complete(back.wait_clients())
+
+        back.send_events([('trigger0', True)])
+        front.send_events([('trigger0', False)])
+        run_until(loop, lambda: len(triggers) == 3)
+        assert sorted(triggers) == [
+            ('any', 'trigger0', False), ('any', 'trigger0', True),
+            ('front', 'trigger0', False)]
+
+        back.write('1', 'switchs', 'switch1')
+        run_until(loop, lambda: changes)
+        assert changes == [(True, 'switch1')]
+
+        snapshot = cluster.snapshot()
+        assert snapshot['back']['switchs']['switch1'] is True
+        assert snapshot['front']['switchs']['switch1'] is False
+        assert loop.run_until_complete(cluster.asnapshot()).keys() \
+            == snapshot.keys()
+        assert cluster.stats()['front']['trigger_events'] == {'trigger0': 1}
+    finally:
+        hals = list(cluster.devices.values())
+        cluster.close()
+        back.stop()
+        front.stop()
+        loop.close()
+    assert all(hal.events_sock is None for hal in hals)
+    assert cluster.watcher is None
+
+
+def test_hal_close_stops_dispatch():
+    loop = asyncio.new_event_loop()
+    driver = FakeDriver(path.join(ROOT, 'single'), n=2, loop=loop)
+    loop.run_until_complete(driver.start())
+    hal = HAL(path.join(ROOT, 'single'))
+    events = []
+    hal.on_trigger()(lambda name, state: events.append(name))
+    hal.switchs['switch0'].on_change(lambda switch: events.append(switch))
+    try:
+        hal.install_loop(loop)
+        loop.run_until_complete(driver.wait_clients())
+        events_sock, watcher_fd = hal.events_sock, hal.watcher.fd
+        hal.close()
+        assert events_sock.fileno() == -1 and hal.watcher is None
+        assert not loop.remove_reader(watcher_fd)
+
+        driver.send_events([('trigger0', True)])
+        driver.write('1', 'switchs', 'switch0')
+        loop.run_until_complete(asyncio.sleep(0.05, loop=loop))
+        assert events == []
+    finally:
+        driver.stop()
+        loop.close()
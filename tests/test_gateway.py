@@ -0,0 +1,136 @@
+from halpy import HAL, Animation, Switch, Trigger
+from halpy.gateway import Gateway, Subscriber, merge
+import asyncio
+import json
+from os import mkdir, path
+from shutil import rmtree
+
+ROOT = path.join('/tmp', 'gatewaytest')
+
+
+def setup_function(*args, **kwargs):
+    mkdir(ROOT)
+    for c in (Switch, Trigger):
+        mkdir(path.join(ROOT, c.hal_type))
+        open(path.join(ROOT, c.hal_type, 'test'), 'w').write('0')
+    mkdir(path.join(ROOT, Animation.hal_type))
+
+
+def teardown_function(*args, **kwargs):
+    rmtree(ROOT)
+
+
+def test_merge():
+    state = {'switchs': {'a': True}}
+    merge(state, {'switchs': {'b': False}, 'triggers': {'c': True}})
+    assert state == {'switchs': {'a': True, 'b': False},
+                     'triggers': {'c': True}}
+
+
+def test_gateway():
+    hal = HAL(ROOT)
+    loop = asyncio.new_event_loop()
+    hal.loop = loop
+    gateway = Gateway(hal)
+    socket_path = path.join(ROOT, 'gateway')
+
+    @asyncio.coroutine
+    def client():
+        reader, writer = yield from asyncio.open_unix_connection(
+            socket_path, loop=loop)
+        first = json.loads((yield from reader.readline()).decode())
+        hal.dispatch_triggers([('test', True)])
+        open(path.join(ROOT, 'switchs', 'test'), 'w').write('1')
+        hal.dispatch_changes([hal.switchs['test']])
+        deltas = {}
+        while deltas.get('switchs') != {'test': True}:
+            line = yield from reader.readline()
+            merge(deltas, json.loads(line.decode())['delta'])
+
+        # Changes recovered after an inotify overflow reach the clients
+        open(path.join(ROOT, 'switchs', 'test'), 'w').write('0')
+        hal.changes_overflowed([])
+        line = yield from reader.readline()
+        assert json.loads(line.decode())['delta']['switchs'] == {'test': False}
+        writer.close()
+        return first, deltas
+
+    try:
+        loop.run_until_complete(gateway.start(socket_path=socket_path))
+        first, second = loop.run_until_complete(client())
+    finally:
+        gateway.close()
+        hal.close()
+    assert first['snapshot']['switchs'] == {'test': False}
+    assert first['snapshot']['triggers'] == {'test': False}
+    assert second == {'switchs': {'test': True}, 'triggers': {'test': True}}
+    assert gateway.state['switchs'] == {'test': False}
+
+    loop.run_until_complete(asyncio.sleep(0.01, loop=loop))
+    assert gateway.subscribers == []
+    loop.close()
+
+
+def test_events_during_snapshot():
+    hal = HAL(ROOT)
+    loop = asyncio.new_event_loop()
+    hal.loop = loop
+    gateway = Gateway(hal)
+    socket_path = path.join(ROOT, 'gateway')
+    start = asyncio.async(gateway.start(socket_path=socket_path), loop=loop)
+    # Dispatched while the snapshot is read in the I/O executor
+    loop.call_soon(hal.dispatch_triggers, [('test', True)])
+
+    @asyncio.coroutine
+    def chatty_client():
+        reader, writer = yield from asyncio.open_unix_connection(
+            socket_path, loop=loop)
+        snapshot = json.loads((yield from reader.readline()).decode())
+        writer.write(bytes(64 * 1024))
+        writer.close()
+        return snapshot['snapshot']
+
+    try:
+        loop.run_until_complete(start)
+        assert gateway.state['triggers'] == {'test': True}
+        snapshot = loop.run_until_complete(chatty_client())
+        assert snapshot['triggers'] == {'test': True}
+    finally:
+        gateway.close()
+        hal.close()
+    loop.run_until_complete(asyncio.sleep(0.01, loop=loop))
+    assert gateway.subscribers == []
+    loop.close()
+
+
+def test_slow_subscriber_coalescing():
+    loop = asyncio.new_event_loop()
+
+    class Transport(object):
+        def set_write_buffer_limits(self, high):
+            pass
+
+    class Writer(object):
+        transport = Transport()
+        lines = []
+
+        def write(self, data):
+            self.lines.append(json.loads(data.decode()))
+
+        @asyncio.coroutine
+        def drain(self):
+            pass
+
+    subscriber = Subscriber(Writer(), loop)
+    for i in range(100):
+        subscriber.push({'switchs': {'test': i % 2 == 0}})
+    subscriber.push({'triggers': {'door': True}})
+    assert subscriber.coalesced == 100
+
+    task = loop.create_task(subscriber.run())
+    loop.run_until_complete(asyncio.sleep(0.01, loop=loop))
+    task.cancel()
+    loop.run_until_complete(asyncio.wait([task], loop=loop))
+    assert [line['delta'] for line in Writer.lines] == [
+        {'switchs': {'test': False}, 'triggers': {'door': True}}]
+    loop.close()
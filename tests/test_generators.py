@@ -1,4 +1,4 @@
-from halpy.generators import Note, Silence, Partition, sinusoid
+from halpy.generators import Note, Silence, Partition, sinusoid, chunks
 
 
 def test_note_defaults():
@@ -27,3 +27,15 @@ def test_sinusoid():
 def test_sinusoid_with_floats():
     frames = sinusoid(n_frames=4, val_min=0.0, val_max=10.0 / 255.0)
     assert frames == [5, 10, 5, 0]
+
+
+def test_partition_iter_frames_is_lazy():
+    p = Partition(*[Note(440)] * 1000)
+    frames = p.iter_frames()
+    assert next(frames) == 44
+    assert len(Partition(*[Note(440)] * 100).to_frames()) == 400
+
+
+def test_chunks():
+    assert list(chunks(range(7), 3)) == [b'\0\1\2', b'\3\4\5', b'\6']
+    assert list(chunks([], 3)) == []
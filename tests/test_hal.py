@@ -1,4 +1,11 @@
 from halpy import HAL, Animation, Switch, Sensor, Trigger
+from halpy.hal import Rgb, EventsReader, FDCache, BoundedHandler
+from halpy.simple_inotify import InotifyWatch
+import asyncio
+import os
+import pytest
+import time
+from array import array
 from os import mkdir, path
 from shutil import rmtree
 
@@ -59,6 +66,17 @@ def test_rel_path():
     assert r.name == 'lolilol'
 
 
+def test_lookup():
+    hal = HAL(ROOT)
+    anim = hal.lookup(path.join(ROOT, 'animations', 'test', 'play'))
+    assert anim is hal.animations['test']
+    switch = hal.lookup(path.join(ROOT, 'switchs', 'test'))
+    assert switch is hal.switchs['test']
+    assert hal.lookup(path.join(ROOT, 'switchs', 'unknown')) is None
+    assert hal.lookup(path.join(ROOT, 'events')) is None
+    assert hal.lookup(path.join(ROOT, 'driver', 'uptime')) is None
+
+
 def test_switch_on():
     hal = HAL(ROOT)
     assert not hal.switchs['test'].on
@@ -75,3 +93,591 @@ def test_switch_on():
 def test_analog_read():
     hal = HAL(ROOT)
     assert hal.sensors['test'].value == 0.0
+
+
+def test_events_reader_batch():
+    reader = EventsReader()
+    assert reader.feed(b'door:1\nbell:0\nbutton:1\n') == [
+        ('door', True), ('bell', False), ('button', True)]
+    assert reader.pending == b''
+
+
+def test_events_reader_partial_line():
+    reader = EventsReader()
+    assert reader.feed(b'door:1\nbe') == [('door', True)]
+    assert reader.feed(b'll:') == []
+    assert reader.feed(b'1\n') == [('bell', True)]
+
+
+def test_dispatch_triggers():
+    hal = HAL(ROOT)
+    calls = []
+
+    @hal.on_trigger('door', True)
+    def door_open(name, state):
+        calls.append(('door_open', name, state))
+
+    @hal.on_trigger()
+    def any_trigger(name, state):
+        calls.append(('any', name, state))
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    assert hal.dispatch_triggers([('door', True), ('bell', False)]) == 2
+    loop.run_until_complete(asyncio.sleep(0))
+    loop.close()
+    assert calls == [
+        ('door_open', 'door', True),
+        ('any', 'door', True),
+        ('any', 'bell', False),
+    ]
+
+
+def test_fd_cache_read_write():
+    hal = HAL(ROOT, fd_cache_size=4)
+    switch = hal.switchs['test']
+    assert not switch.on
+    switch.on = True
+    assert switch.on
+    assert open(path.join(ROOT, 'switchs', 'test')).read() == '1'
+    assert hal.animations['test'].fps == '25'
+    hal.animations['test'].fps = 4
+    assert hal.animations['test'].fps == '4'
+    assert open(path.join(ROOT, 'animations', 'test', 'fps')).read() == '4'
+    # Only reads are pooled, writes close their file
+    assert all(flags == os.O_RDONLY for _, flags in hal.fd_cache.fds)
+    hal.close()
+    assert hal.fd_cache.fds == {}
+
+
+def test_fd_cache_writes_are_seen_by_inotify():
+    hal = HAL(ROOT, fd_cache_size=4)
+    watcher = InotifyWatch(ROOT, resolve=hal.lookup)
+    hal.switchs['test'].on = True
+    assert watcher.get_all() == [hal.switchs['test']]
+    os.close(watcher.fd)
+
+
+def test_fd_cache_removed_resource():
+    hal = HAL(ROOT, fd_cache_size=4)
+    switch_path = path.join(ROOT, 'switchs', 'test')
+    assert not hal.switchs.test.on
+    assert hal.animations.test.fps == '25'
+    os.remove(switch_path)
+    hal.tree_changed(switch_path, False)
+    assert list(hal.fd_cache.fds) == [
+        (('animations', 'test', 'fps'), os.O_RDONLY)]
+    open(switch_path, 'w').write('1')
+    hal.tree_changed(switch_path, True)
+    assert hal.switchs.test.on
+    hal.close()
+
+
+def test_fd_cache_lru_eviction():
+    cache = FDCache(ROOT, 2)
+    cache.read(('switchs', 'test'))
+    cache.read(('sensors', 'test'))
+    cache.read(('switchs', 'test'))
+    cache.read(('triggers', 'test'))
+    assert [k[0] for k in cache.fds] == [
+        ('switchs', 'test'), ('triggers', 'test')]
+    cache.close()
+
+
+def test_coalesced_writes():
+    loop = asyncio.new_event_loop()
+    hal = HAL(ROOT, coalesce_writes=True)
+    hal.loop = loop
+    switch = hal.switchs['test']
+    for i in range(9):
+        switch.on = i % 2 == 0
+    assert open(path.join(ROOT, 'switchs', 'test')).read() == '0'
+    assert switch.on
+
+    loop.run_until_complete(asyncio.sleep(0))
+    loop.close()
+    assert open(path.join(ROOT, 'switchs', 'test')).read() == '1'
+    assert hal.flushed_writes == 1
+    assert hal.dropped_writes == 8
+
+
+def test_coalesced_writes_flush():
+    hal = HAL(ROOT, coalesce_writes=True)
+    hal.loop = asyncio.new_event_loop()
+    hal.switchs['test'].on = True
+    assert hal.switchs['test'].on
+    hal.flush()
+    assert open(path.join(ROOT, 'switchs', 'test')).read() == '1'
+    assert hal.flush_handle is None
+    hal.loop.close()
+
+
+def test_coalesced_writes_from_threads():
+    loop = asyncio.new_event_loop()
+    hal = HAL(ROOT, coalesce_writes=True, io_workers=4)
+    hal.loop = loop
+    switch = hal.switchs['test']
+    sets = [switch.set_on(i % 2 == 0) for i in range(200)] + [
+        switch.set_on(True)]
+    loop.run_until_complete(asyncio.gather(*sets, loop=loop))
+    loop.run_until_complete(asyncio.sleep(0.01, loop=loop))
+    assert hal.flushed_writes + hal.dropped_writes == 201
+    assert hal.pending_writes == {} and hal.flush_handle is None
+    hal.close()
+    loop.close()
+
+
+def test_read_cache():
+    hal = HAL(ROOT, cache_reads=True)
+    hal.watcher = InotifyWatch(ROOT)
+    anim = hal.animations['test']
+    assert anim.fps == '25'
+    assert not anim.playing
+    open(path.join(ROOT, 'animations', 'test', 'fps'), 'w').write('30')
+    assert anim.fps == '25'
+
+    anim.playing = True
+    assert anim.playing
+    assert anim.fps == '25'
+
+    hal.dispatch_changes([anim])
+    assert anim.fps == '30'
+    hal.close()
+
+
+def test_read_cache_needs_watcher():
+    hal = HAL(ROOT, cache_reads=True)
+    assert hal.switchs.test.on is False
+    open(path.join(ROOT, 'switchs', 'test'), 'w').write('1')
+    assert hal.switchs.test.on is True
+    assert hal.read_cache == {}
+
+
+def test_read_cache_triggers():
+    hal = HAL(ROOT, cache_reads=True)
+    hal.watcher = InotifyWatch(ROOT)
+    assert not hal.triggers['test'].on
+    hal.dispatch_triggers([('test', True)])
+    assert hal.triggers['test'].on
+    hal.close()
+
+
+def test_read_cache_ignores_sensors():
+    hal = HAL(ROOT, cache_reads=True)
+    assert hal.sensors['test'].value == 0
+    open(path.join(ROOT, 'sensors', 'test'), 'w').write('0.5')
+    assert hal.sensors['test'].value == 0.5
+
+
+def test_read_cache_ignores_play():
+    hal = HAL(ROOT, cache_reads=True)
+    hal.watcher = InotifyWatch(ROOT)
+    anim = hal.animations['test']
+    anim.playing = True
+    assert anim.playing and anim.fps == '25'
+    # The driver stops non-looping animations without inotify events
+    open(path.join(ROOT, 'animations', 'test', 'play'), 'w').write('0')
+    open(path.join(ROOT, 'animations', 'test', 'fps'), 'w').write('30')
+    assert not anim.playing and anim.fps == '25'
+    hal.close()
+
+
+def test_trigger_index():
+    hal = HAL(ROOT)
+    door_open = hal.on_trigger('door', True)(lambda *args: None)
+    door = hal.on_trigger('door')(lambda *args: None)
+    opened = hal.on_trigger(None, True)(lambda *args: None)
+    every = hal.on_trigger()(lambda *args: None)
+    index = hal.build_trigger_index()
+
+    names = lambda key: [h.__wrapped__ for h in index[key]]
+    assert names(('door', True)) == [door_open, door, opened, every]
+    assert names(('door', False)) == [door, every]
+    assert names((None, True)) == [opened, every]
+    assert names((None, False)) == [every]
+
+
+def test_trigger_index_rebuilt_on_registration():
+    hal = HAL(ROOT)
+    hal.on_trigger('door')(lambda *args: None)
+    hal.build_trigger_index()
+    hal.on_trigger('door')(lambda *args: None)
+    assert hal.trigger_index is None
+    assert len(hal.build_trigger_index()['door', True]) == 2
+
+
+def test_coroutine_api():
+    loop = asyncio.new_event_loop()
+    hal = HAL(ROOT, io_workers=2, io_limit=1)
+    hal.loop = loop
+    switch, anim = hal.switchs['test'], hal.animations['test']
+
+    assert not loop.run_until_complete(switch.get_on())
+    loop.run_until_complete(switch.set_on(True))
+    assert open(path.join(ROOT, 'switchs', 'test')).read() == '1'
+    assert loop.run_until_complete(switch.get_on())
+
+    loop.run_until_complete(anim.set_frames([1, 2, 3]))
+    assert loop.run_until_complete(anim.get_frames()) == [1, 2, 3]
+    assert loop.run_until_complete(hal.aread('animations', 'test', 'fps'))\
+        == '25'
+
+    hal.close()
+    loop.close()
+
+
+def test_snapshot():
+    hal = HAL(ROOT)
+    hal.switchs['test'].on = True
+    snap = hal.snapshot()
+    assert snap['switchs'] == {'test': True}
+    assert snap['triggers'] == {'test': False}
+    assert snap['sensors'] == {'test': 0.0}
+    assert snap['rgbs'] == {}
+    assert snap['animations']['test'] == {
+        'playing': False, 'looping': False, 'fps': '25'}
+    assert snap.timestamp > 0
+    with pytest.raises(TypeError):
+        snap['switchs']['test'] = False
+
+    loop = asyncio.new_event_loop()
+    hal.loop = loop
+    assert loop.run_until_complete(hal.asnapshot()) == snap
+    hal.close()
+    loop.close()
+
+
+def test_lazy_collections():
+    hal = HAL(ROOT)
+    assert hal.switchs.resources is None
+    assert hal.switchs.test is hal.switchs['test']
+    assert list(hal.switchs.resources) == ['test']
+    assert len(hal.rgbs) == 0
+    with pytest.raises(AttributeError):
+        hal.switchs.unknown
+
+
+def test_hotplug():
+    hal = HAL(ROOT)
+    assert 'test' in hal.switchs
+    open(path.join(ROOT, 'switchs', 'new'), 'w').write('1')
+    hal.tree_changed(path.join(ROOT, 'switchs', 'new'), True)
+    assert hal.switchs.new.on
+    hal.tree_changed(path.join(ROOT, 'switchs', 'test'), False)
+    assert list(hal.switchs.keys()) == ['new']
+
+
+def test_resync():
+    hal = HAL(ROOT)
+    loop = asyncio.new_event_loop()
+    hal.loop = loop
+    anim, switch = hal.animations['test'], hal.switchs['test']
+    # Without a recorded state, the first resync reports everything
+    assert hal.known_state == {}
+    assert set(loop.run_until_complete(hal.resync())) == {
+        anim, switch, hal.triggers['test']}
+    assert loop.run_until_complete(hal.resync()) == []
+
+    # The state of dispatched resources is refreshed, not reported again
+    open(path.join(ROOT, 'animations', 'test', 'fps'), 'w').write('30')
+    open(path.join(ROOT, 'switchs', 'test'), 'w').write('1')
+    hal.dispatch_changes([switch])
+    loop.run_until_complete(asyncio.sleep(0.01, loop=loop))
+    assert hal.known_state['switchs', 'test'] == (True,)
+    assert loop.run_until_complete(hal.resync()) == [anim]
+    assert hal.known_state['animations', 'test'] == (False, False, '30', None)
+
+    # Recovered changes are seen by observers (eg. trace recorders)
+    observed = []
+    hal.add_observer(lambda kind, items: observed.append((kind, items)))
+    open(path.join(ROOT, 'switchs', 'test'), 'w').write('0')
+    hal.changes_overflowed([])
+    loop.run_until_complete(asyncio.sleep(0.01, loop=loop))
+    assert observed == [('changes', [switch])]
+
+    # Sensors change without inotify events, they are never resynced
+    open(path.join(ROOT, 'sensors', 'test'), 'w').write('0.5')
+    assert loop.run_until_complete(hal.resync()) == []
+    assert 'sensors' not in hal.resync_properties
+    hal.close()
+    loop.close()
+
+
+def test_record_state():
+    hal = HAL(ROOT)
+    loop = asyncio.new_event_loop()
+    hal.loop = loop
+    loop.run_until_complete(hal.record_state())
+    assert hal.known_state['switchs', 'test'] == (False,)
+    # Only the resources that changed since then are reported
+    open(path.join(ROOT, 'switchs', 'test'), 'w').write('1')
+    assert loop.run_until_complete(hal.resync()) == [hal.switchs['test']]
+    hal.close()
+    loop.close()
+
+
+def run_bounded(policy, queue_size=0, calls=4):
+    """Call a slow handler `calls` times, return the arguments it ran with"""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    release = asyncio.Event(loop=loop)
+    started = []
+
+    @asyncio.coroutine
+    def slow(i):
+        started.append(i)
+        yield from release.wait()
+        return i
+
+    handler = BoundedHandler(slow, 1, queue_size, policy)
+    futures = [handler(i) for i in range(calls)]
+    loop.run_until_complete(asyncio.sleep(0))
+    release.set()
+    loop.run_until_complete(asyncio.wait(futures, loop=loop))
+    loop.close()
+    assert handler.running == [] and len(handler.queue) == 0
+    return started, handler.dropped
+
+
+def test_bounded_drop_new():
+    assert run_bounded('drop-new') == ([0], 3)
+    assert run_bounded('drop-new', queue_size=2) == ([0, 1, 2], 1)
+
+
+def test_bounded_drop_old():
+    assert run_bounded('drop-old', queue_size=2) == ([0, 2, 3], 1)
+
+
+def test_bounded_latest():
+    assert run_bounded('latest', queue_size=5) == ([0, 3], 2)
+
+
+def test_bounded_cancel():
+    assert run_bounded('cancel') == ([3], 3)
+
+
+def test_bounded_policy_validation():
+    with pytest.raises(ValueError):
+        BoundedHandler(lambda: None, 1, policy='whatever')
+    with pytest.raises(ValueError):
+        BoundedHandler(lambda: None, 0)
+    with pytest.raises(ValueError):
+        BoundedHandler(lambda: None, 1, policy='drop-old')
+
+
+def test_dropped_calls_latency():
+    hal = HAL(ROOT)
+    loop = asyncio.new_event_loop()
+    hal.use_loop(loop)
+    release = asyncio.Event(loop=loop)
+
+    @hal.on_trigger('door', max_concurrent=1)
+    def slow(name, state):
+        yield from release.wait()
+
+    hal.dispatch_triggers([('door', True)] * 10)
+    release.set()
+    loop.run_until_complete(asyncio.sleep(0.01, loop=loop))
+    loop.close()
+    stats = hal.stats()
+    assert stats['dropped_calls_total'] == 9
+    assert stats['handler_latency']['slow']['count'] == 1
+
+
+def test_bounded_registration():
+    hal = HAL(ROOT)
+    hal.on_trigger('door', max_concurrent=2, policy='latest')(lambda: None)
+    hal.triggers['test'].on_trigger(True, max_concurrent=1)(lambda: None)
+    hal.switchs['test'].on_change(max_concurrent=1)(lambda r: None)
+    hal.switchs['test'].on_change(lambda r: None)
+    index = hal.build_trigger_index()
+    assert index['door', True][0].limit == 2
+    assert index['test', True][0].policy == 'drop-new'
+    handlers = hal.build_change_index()[Switch, 'test']
+    assert isinstance(handlers[0], BoundedHandler)
+    assert not isinstance(handlers[1], BoundedHandler)
+
+
+def test_handlers_run_in_hal_loop():
+    hal = HAL(ROOT)
+    calls = []
+
+    @asyncio.coroutine
+    def record(name, state):
+        calls.append(name)
+
+    hal.on_trigger('plain')(record)
+    hal.on_trigger('bounded', max_concurrent=1)(record)
+    default_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(default_loop)
+    loop = asyncio.new_event_loop()
+    hal.use_loop(loop)
+    hal.dispatch_triggers([('plain', True), ('bounded', True)])
+    loop.run_until_complete(asyncio.sleep(0.01, loop=loop))
+    assert sorted(calls) == ['bounded', 'plain']
+    loop.close()
+    default_loop.close()
+
+
+def test_stats():
+    hal = HAL(ROOT)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    @hal.on_trigger('door')
+    def door(name, state):
+        if state:
+            raise ValueError("Broken handler")
+
+    hal.dispatch_triggers([('door', False), ('door', True), ('bell', True)])
+    hal.dispatch_changes([hal.switchs['test']])
+    loop.run_until_complete(asyncio.sleep(0))
+    loop.close()
+
+    stats = hal.stats()
+    assert stats['trigger_events'] == {'door': 2, 'bell': 1}
+    assert stats['change_events'] == {'switchs/test': 1}
+    assert stats['handler_calls'] == {'door': 2}
+    assert stats['handler_errors'] == {'door': 1}
+    assert stats['handler_latency']['door']['count'] == 2
+    assert stats['dropped_writes_total'] == 0
+
+    hal.dump_metrics(path.join(ROOT, 'metrics.prom'))
+    text = open(path.join(ROOT, 'metrics.prom')).read()
+    assert 'halpy_handler_errors_total{handler="door"} 1' in text
+
+
+def test_serve_metrics():
+    hal = HAL(ROOT)
+    loop = asyncio.new_event_loop()
+    hal.loop = loop
+    socket_path = path.join(ROOT, 'metrics.sock')
+    server = loop.run_until_complete(hal.serve_metrics(socket_path))
+
+    @asyncio.coroutine
+    def fetch():
+        reader, writer = yield from asyncio.open_unix_connection(
+            socket_path, loop=loop)
+        return (yield from reader.read())
+
+    text = loop.run_until_complete(fetch()).decode()
+    server.close()
+    loop.run_until_complete(server.wait_closed())
+    loop.close()
+    assert text == hal.prometheus()
+
+
+def test_frames_roundtrip():
+    hal = HAL(ROOT)
+    anim = hal.animations['test']
+    anim.frames = [10, 32, 0, 255, 10]
+    assert anim.frames == [10, 32, 0, 255, 10]
+    assert anim.frames_view.tobytes() == bytes([10, 32, 0, 255, 10])
+
+
+def test_skip_redundant_uploads():
+    hal = HAL(ROOT)
+    hal.watcher = InotifyWatch(ROOT)
+    anim = hal.animations['test']
+    frames_path = path.join(ROOT, Animation.hal_type, 'test', 'frames')
+    assert anim.configure(frames=[1, 2, 3], fps=25, looping=True) == 3
+    assert anim.configure(frames=bytes([1, 2, 3]), fps=25, looping=True) == 0
+    anim.fps = 25
+    assert hal.skipped_writes == 4
+    assert anim.configure(frames=[1, 2, 3], force=True) == 1
+
+    # Our own write, seen by inotify, keeps the memo
+    hal.dispatch_changes([anim])
+    assert anim.configure(frames=[1, 2, 3]) == 0
+
+    # An external write is noticed
+    open(frames_path, 'wb').write(b'\x09')
+    hal.dispatch_changes([anim])
+    assert 'frames' not in anim.uploaded and 'fps' in anim.uploaded
+    anim.frames = [1, 2, 3]
+    assert anim.frames == [1, 2, 3]
+    assert hal.counters()['skipped_writes_total'] == 5
+    os.close(hal.watcher.fd)
+
+
+def test_no_skipped_uploads_without_watcher():
+    first, second = HAL(ROOT), HAL(ROOT)
+    first.animations['test'].frames = [1, 2, 3]
+    second.animations['test'].frames = [9, 9]
+    first.animations['test'].frames = [1, 2, 3]
+    assert second.animations['test'].frames == [1, 2, 3]
+    assert first.skipped_writes == 0
+
+
+def test_encode_frames():
+    encode = Animation.encode_frames
+    data = bytearray(b'\x01\x02')
+    assert encode(data) is data
+    assert bytes(encode(array('B', [1, 2]))) == b'\x01\x02'
+    assert bytes(encode(memoryview(array('H', [1, 2])))) == b'\x01\x02'
+    assert encode(memoryview(b'\x01\x02\x03\x04')[::2]) == b'\x01\x03'
+    assert encode([255, 1.0, 0.5]) == b'\xff\xff\x7f'
+    for illegal in ([], [256], [-1], [1.5], bytes(256)):
+        with pytest.raises(ValueError):
+            encode(illegal)
+
+
+def test_encode_ndarray():
+    np = pytest.importorskip('numpy')
+    encode = Animation.encode_frames
+    frames = np.arange(10, dtype='u1')
+    view = encode(frames)
+    assert view.obj is frames
+    assert bytes(encode(np.array([0, 0.5, 1.0]))) == b'\x00\x7f\xff'
+    assert bytes(encode(np.arange(0, 200, 50))) == b'\x00\x32\x64\x96'
+    assert bytes(encode(np.arange(4, dtype='u1')[::2])) == b'\x00\x02'
+    for illegal in (np.array([1.5]), np.array([256]), np.array([-1]),
+                    np.zeros(256), np.zeros((2, 2)), np.array(['a'])):
+        with pytest.raises(ValueError):
+            encode(illegal)
+
+    hal = HAL(ROOT)
+    hal.animations['test'].frames = np.linspace(0, 1, 3)
+    assert hal.animations['test'].frames == [0, 127, 255]
+
+
+def test_rgb_fade():
+    mkdir(path.join(ROOT, Rgb.hal_type))
+    open(path.join(ROOT, Rgb.hal_type, 'led'), 'w').write('#000000')
+    hal = HAL(ROOT)
+    hal.loop = asyncio.new_event_loop()
+    led = hal.rgbs['led']
+    assert Rgb.parse_color('#f80') == (255, 136, 0)
+    assert Rgb.parse_color((1.0, 0, 300)) == (255, 0, 255)
+
+    start = hal.loop.time()
+    fade = led.fade_to('#ff0000', 0.1, fps=100)
+    assert fade.done() is False
+    written = hal.loop.run_until_complete(fade)
+    assert hal.loop.time() - start >= 0.1
+    assert led.css == '#ff0000'
+    assert written + led.fading.skipped == 10
+
+    # A late loop skips steps instead of writing them all
+    fade = led.fade_to('#000000', 0.1, fps=100)
+    time.sleep(0.05)
+    hal.loop.run_until_complete(fade)
+    assert led.fading.skipped >= 4 and led.css == '#000000'
+
+    # A new fade cancels the running one, and starts from its color
+    first = led.fade_to('#00ff00', 1, easing=lambda t: 1 - (1 - t) ** 2)
+    hal.loop.run_until_complete(asyncio.sleep(0.2, loop=hal.loop))
+    midway = led.color
+    assert 0 < midway[1] < 255
+    second = led.fade_to('#0000ff', 0.05)
+    assert first.cancelled()
+    assert led.fading.steps[0] == '#%02x%02x%02x' % midway
+    hal.loop.run_until_complete(second)
+    assert led.css == '#0000ff'
+
+    # A failing write ends the fade with its error
+    fade = led.fade_to('#ffffff', 0.05)
+    rmtree(path.join(ROOT, Rgb.hal_type))
+    with pytest.raises(OSError):
+        hal.loop.run_until_complete(
+            asyncio.wait_for(fade, 1, loop=hal.loop))
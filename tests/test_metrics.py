@@ -0,0 +1,37 @@
+from halpy.metrics import Histogram, Metrics
+
+
+def test_histogram():
+    h = Histogram(buckets=(1, 10))
+    for value in (0.5, 1, 5, 50):
+        h.observe(value)
+    assert h.count == 4
+    assert h.sum == 56.5
+    assert h.cumulative() == [(1, 2), (10, 3), (float('inf'), 4)]
+
+
+def test_prometheus():
+    m = Metrics()
+    m.trigger_events['door'] += 2
+    m.change_events['switchs', 'power'] += 1
+    m.handler_calls['door_open'] += 2
+    m.observe_latency('door_open', 0.002)
+    text = m.prometheus({'dropped_writes_total': 3})
+    lines = text.splitlines()
+    assert 'halpy_trigger_events_total{trigger="door"} 2' in lines
+    assert ('halpy_change_events_total{resource="power",type="switchs"} 1'
+            in lines)
+    assert ('halpy_handler_latency_seconds_bucket'
+            '{handler="door_open",le="0.005"} 1') in lines
+    assert ('halpy_handler_latency_seconds_bucket'
+            '{handler="door_open",le="+Inf"} 1') in lines
+    assert 'halpy_handler_latency_seconds_count{handler="door_open"} 1' \
+        in lines
+    assert 'halpy_dropped_writes_total 3' in lines
+    assert text.endswith('\n')
+
+
+def test_as_dict():
+    m = Metrics()
+    m.change_events['switchs', 'power'] += 1
+    assert m.as_dict()['change_events'] == {'switchs/power': 1}
@@ -0,0 +1,79 @@
+import pytest
+import asyncio
+from os import mkdir, path
+from shutil import rmtree
+from halpy import HAL, Sensor
+
+np = pytest.importorskip('numpy')
+
+ROOT = path.join('/tmp', 'samplingtest')
+
+
+def setup_function(*args, **kwargs):
+    mkdir(ROOT)
+    mkdir(path.join(ROOT, Sensor.hal_type))
+    for name, value in (('light', '0.5'), ('temp', '0.25')):
+        open(path.join(ROOT, Sensor.hal_type, name), 'w').write(value)
+
+
+def teardown_function(*args, **kwargs):
+    rmtree(ROOT)
+
+
+def make_sampler(window):
+    from halpy.sampling import SensorSampler
+    return SensorSampler(HAL(ROOT), 10, window, loop=asyncio.new_event_loop())
+
+
+def test_ring_buffer_stats():
+    sampler = make_sampler(3)
+    assert sampler.sensors == ['light', 'temp']
+    for i in range(5):
+        sampler.push([i, 10 * i], i)
+    assert sampler.samples().tolist() == [[2, 20], [3, 30], [4, 40]]
+    assert sampler.mean().tolist() == [3, 30]
+    assert sampler.min().tolist() == [2, 20]
+    assert sampler.max().tolist() == [4, 40]
+    assert sampler.as_dict(sampler.max()) == {'light': 4, 'temp': 40}
+
+
+def test_ema():
+    sampler = make_sampler(3)
+    for i in range(3):
+        sampler.push([i, i], i)
+    assert np.allclose(sampler.ema(0.5), (0 * 1 + 1 * 2 + 2 * 4) / 7)
+    assert np.allclose(sampler.ema(0), 1)
+
+
+def test_sample_blocks():
+    loop = asyncio.new_event_loop()
+    hal = HAL(ROOT)
+    sampler = hal.sample_sensors(200, 8, loop=loop)
+    stream = sampler.blocks(3)
+    block = loop.run_until_complete(stream.__anext__())
+    sampler.stop()
+    hal.close()
+    loop.close()
+    assert block.tolist() == [[0.5, 0.25]] * 3
+    assert stream.position == 3
+
+
+def test_sample_read_errors():
+    loop = asyncio.new_event_loop()
+    hal = HAL(ROOT)
+    sampler = hal.sample_sensors(200, 8, loop=loop)
+    open(path.join(ROOT, Sensor.hal_type, 'temp'), 'w').write('garbled')
+    block = loop.run_until_complete(sampler.blocks(2).__anext__())
+    assert block[:, 0].tolist() == [0.5, 0.5]
+    assert np.isnan(block[:, 1]).all()
+
+    # A fatal error is raised in the consumers
+    sampler.read_all = lambda: 1 / 0
+    with pytest.raises(ZeroDivisionError):
+        loop.run_until_complete(sampler.blocks(1).__anext__())
+    assert isinstance(sampler.error, ZeroDivisionError)
+    with pytest.raises(ZeroDivisionError):
+        loop.run_until_complete(sampler.wait())
+    sampler.stop()
+    hal.close()
+    loop.close()
@@ -0,0 +1,101 @@
+from halpy import HAL
+from halpy.scheduler import Job, Scheduler, parse_time, seconds_until
+import asyncio
+import pytest
+from datetime import datetime, time, timedelta
+from os import mkdir, path
+from shutil import rmtree
+
+ROOT = path.join('/tmp', 'schedulertest')
+
+
+def setup_function(*args, **kwargs):
+    mkdir(ROOT)
+
+
+def teardown_function(*args, **kwargs):
+    rmtree(ROOT)
+
+
+def run_for(loop, seconds):
+    loop.run_until_complete(asyncio.sleep(seconds, loop=loop))
+
+
+def test_parse_time():
+    assert parse_time('02:00') == time(2, 0)
+    assert parse_time('23:59:30') == time(23, 59, 30)
+    with pytest.raises(ValueError):
+        parse_time('12')
+    now = datetime(2015, 3, 1, 12, 0)
+    assert seconds_until(time(13, 0), now) == 3600
+    assert seconds_until(time(12, 0), now) == 24 * 3600
+
+
+def test_missed_runs_policies():
+    for policy, expected in (('once', 1), ('all', 4), ('skip', 0)):
+        job = Job(None, None, interval=10, missed=policy)
+        job.deadline = 100
+        assert job.due_runs(100.5) == 1 and job.deadline == 110
+        assert job.due_runs(140) == expected and job.deadline == 150
+        assert job.missed == 3
+    with pytest.raises(ValueError):
+        Job(None, None, interval=10, missed='never')
+    with pytest.raises(ValueError):
+        Job(None, None, interval=10, jitter=10)
+
+
+def armed_timers(loop):
+    return sum(not handle._cancelled for handle in loop._scheduled)
+
+
+def test_single_timer():
+    loop = asyncio.new_event_loop()
+    calls = []
+    scheduler = Scheduler(lambda handler: calls.append(handler))
+    for i in range(100):
+        scheduler.add(Job(None, i, delay=1 + i, interval=100))
+    scheduler.start(loop)
+    assert len(scheduler.heap) == 100
+    assert armed_timers(loop) == 1
+    scheduler.add(Job(None, 'first', delay=0.01))
+    assert armed_timers(loop) == 1
+    run_for(loop, 0.05)
+    assert calls == ['first'] and len(scheduler.jobs) == 100
+    scheduler.stop()
+    loop.close()
+
+
+def test_hal_every_after_at():
+    hal = HAL(ROOT)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    calls = []
+
+    @hal.every(0.02)
+    def pulse():
+        calls.append('pulse')
+
+    @hal.after(0.05)
+    def later():
+        calls.append('later')
+
+    @hal.at(datetime.now() - timedelta(seconds=10))
+    def passed():
+        calls.append('passed')
+
+    @hal.at('02:00')
+    def power_off():
+        calls.append('power_off')
+
+    hal.scheduler.start(loop)
+    run_for(loop, 0.11)
+    hal.close()
+    loop.close()
+
+    assert calls[0] == 'passed'
+    assert calls.count('later') == 1
+    assert 4 <= calls.count('pulse') <= 5
+    assert [job.func for job in hal.scheduler.jobs] == [pulse, power_off]
+    stats = hal.stats()
+    assert stats['handler_calls']['pulse'] == calls.count('pulse')
+    assert stats['missed_runs_total'] == 0
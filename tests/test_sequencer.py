@@ -0,0 +1,64 @@
+from halpy import HAL, Animation
+from halpy.generators import Note, Partition
+from halpy.sequencer import play_frames, play_partition
+import asyncio
+from os import makedirs, path
+from shutil import rmtree
+
+ROOT = path.join('/tmp', 'sequencertest')
+
+
+def setup_function(*args, **kwargs):
+    makedirs(path.join(ROOT, Animation.hal_type, 'buzzer'))
+    for name, value in (('play', '0'), ('loop', '1'), ('fps', '1000')):
+        filename = path.join(ROOT, Animation.hal_type, 'buzzer', name)
+        open(filename, 'w').write(value)
+
+
+def teardown_function(*args, **kwargs):
+    rmtree(ROOT)
+
+
+def recorded_uploads(hal):
+    uploads = []
+    write = hal.write
+
+    def record(value, *filepath, **kwargs):
+        if filepath[-1] == 'frames':
+            uploads.append((hal.loop.time(), bytes(value)))
+        write(value, *filepath, **kwargs)
+    hal.write = record
+    return uploads
+
+
+def test_play_frames_in_chunks():
+    hal = HAL(ROOT)
+    hal.loop = asyncio.new_event_loop()
+    uploads = recorded_uploads(hal)
+    buzzer = hal.animations.buzzer
+    frames = (i % 256 for i in range(600))
+
+    start = hal.loop.time()
+    played = hal.loop.run_until_complete(play_frames(buzzer, frames))
+    assert played == 600
+    assert hal.loop.time() - start >= 0.6
+    assert [len(chunk) for t, chunk in uploads] == [255, 255, 90]
+    assert uploads[1][0] - start >= 0.255
+    assert uploads[2][0] - start >= 0.510
+    assert buzzer.frames == [i % 256 for i in range(510, 600)]
+    assert buzzer.playing and not buzzer.looping
+
+
+def test_play_partition_cancelled():
+    hal = HAL(ROOT)
+    hal.loop = asyncio.new_event_loop()
+    uploads = recorded_uploads(hal)
+    buzzer = hal.animations.buzzer
+    tune = Partition(*[Note(440)] * 1000)
+
+    task = hal.loop.create_task(play_partition(buzzer, tune, fps=500))
+    hal.loop.run_until_complete(asyncio.sleep(0.6, loop=hal.loop))
+    task.cancel()
+    hal.loop.run_until_complete(asyncio.wait([task], loop=hal.loop))
+    assert len(uploads) == 2
+    assert buzzer.fps == '500' and not buzzer.playing
@@ -0,0 +1,91 @@
+from halpy.simple_inotify import (
+    InotifyWatch, IN_MODIFY, IN_Q_OVERFLOW, inotify_event_header)
+import os
+from os import mkdir, path, remove
+from shutil import rmtree
+
+ROOT = path.join('/tmp', 'inotifytest')
+
+
+def setup_function(*args, **kwargs):
+    mkdir(ROOT)
+    for name in ('a', 'b'):
+        open(path.join(ROOT, name), 'w').write('0')
+
+
+def teardown_function(*args, **kwargs):
+    rmtree(ROOT)
+
+
+def write(name, value):
+    with open(path.join(ROOT, name), 'w') as f:
+        f.write(value)
+
+
+def test_get_all_drains_queue():
+    watcher = InotifyWatch(ROOT)
+    write('a', '1')
+    write('b', '1')
+    assert watcher.get_all() == [path.join(ROOT, 'a'), path.join(ROOT, 'b')]
+
+
+def test_get_all_coalesces_writes():
+    watcher = InotifyWatch(ROOT)
+    for i in range(10):
+        write('b', str(i))
+        write('a', str(i))
+    assert list(watcher) == [path.join(ROOT, 'b'), path.join(ROOT, 'a')]
+
+
+def test_get_all_resolved():
+    watcher = InotifyWatch(ROOT, resolve=lambda p: path.basename(p).upper())
+    write('a', '1')
+    write('b', '1')
+    write('a', '2')
+    assert watcher.get_all() == ['A', 'B']
+
+
+def test_new_files_are_watched():
+    changes = []
+    watcher = InotifyWatch(ROOT, on_tree_change=lambda *a: changes.append(a))
+    mkdir(path.join(ROOT, 'd'))
+    write('c', '1')
+    remove(path.join(ROOT, 'a'))
+    assert watcher.get_all() == [path.join(ROOT, 'c')]
+    assert changes == [
+        (path.join(ROOT, 'd'), True),
+        (path.join(ROOT, 'c'), True),
+        (path.join(ROOT, 'a'), False),
+    ]
+
+    write('c', '2')
+    write(path.join('d', 'e'), '1')
+    assert watcher.get_all() == [
+        path.join(ROOT, 'c'), path.join(ROOT, 'd', 'e')]
+
+
+def test_one_watch_per_directory():
+    mkdir(path.join(ROOT, 'd'))
+    watcher = InotifyWatch(ROOT)
+    assert sorted(watcher.followed.values()) == [ROOT, path.join(ROOT, 'd')]
+
+
+def test_custom_mask():
+    watcher = InotifyWatch(ROOT, mask=IN_MODIFY)
+    fd = os.open(path.join(ROOT, 'b'), os.O_WRONLY)
+    os.write(fd, b'1')
+    assert watcher.get_all() == [path.join(ROOT, 'b')]
+    os.close(fd)
+
+
+def test_overflow():
+    watcher = InotifyWatch(ROOT)
+    r, w = os.pipe()
+    os.write(w, inotify_event_header.pack(-1, IN_Q_OVERFLOW, 0, 0))
+    os.close(watcher.fd)
+    watcher.fd = r
+    assert watcher.get_all() == []
+    assert watcher.overflowed
+    assert watcher.overflows == 1
+    os.close(w)
+    os.close(r)
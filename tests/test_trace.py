@@ -0,0 +1,62 @@
+import asyncio
+from os import mkdir, path
+from shutil import rmtree
+from halpy import HAL, Switch, Trigger
+from halpy.trace import TraceRecorder, read_trace, replay
+
+ROOT = path.join('/tmp', 'tracetest')
+
+
+def setup_function(*args, **kwargs):
+    mkdir(ROOT)
+    for c in (Switch, Trigger):
+        mkdir(path.join(ROOT, c.hal_type))
+        open(path.join(ROOT, c.hal_type, 'test'), 'w').write('0')
+
+
+def teardown_function(*args, **kwargs):
+    rmtree(ROOT)
+
+
+def record(filename):
+    loop = asyncio.new_event_loop()
+    # The loops are closed before the resync state of changes is refreshed
+    hal = HAL(ROOT, resync_on_overflow=False)
+    hal.loop = loop
+    with TraceRecorder(hal, filename) as recorder:
+        hal.dispatch_triggers([('door', True), ('bell', False)])
+        hal.dispatch_changes([hal.switchs['test']])
+        hal.dispatch_triggers([('door', False)])
+    loop.close()
+    assert recorder.recorded == 4
+    assert hal.observers == []
+
+
+def test_record():
+    filename = path.join(ROOT, 'trace.gz')
+    record(filename)
+    batches = read_trace(filename)
+    assert [(kind, items) for t, kind, items in batches] == [
+        ('triggers', [('door', True), ('bell', False)]),
+        ('changes', [('switchs', 'test')]),
+        ('triggers', [('door', False)]),
+    ]
+
+
+def test_replay():
+    filename = path.join(ROOT, 'trace')
+    record(filename)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    hal = HAL(ROOT, resync_on_overflow=False)
+    hal.loop = loop
+    seen = []
+    hal.add_observer(lambda kind, items: seen.append((kind, list(items))))
+    assert loop.run_until_complete(replay(hal, filename, speed=None)) == 4
+    loop.close()
+    assert seen == [
+        ('triggers', [('door', True), ('bell', False)]),
+        ('changes', [hal.switchs['test']]),
+        ('triggers', [('door', False)]),
+    ]
+    assert hal.stats()['trigger_events'] == {'door': 2, 'bell': 1}
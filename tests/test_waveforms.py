@@ -0,0 +1,48 @@
+import pytest
+from halpy.generators import sinusoid
+
+np = pytest.importorskip('numpy')
+waveforms = pytest.importorskip('halpy.waveforms')
+
+
+def test_sine_matches_sinusoid():
+    assert list(waveforms.sine(10, 0, 200)) == sinusoid(10, 0, 200)
+
+
+def test_waveforms_shapes():
+    assert list(waveforms.triangle(4, 0, 200)) == [0, 100, 200, 100]
+    assert list(waveforms.sawtooth(3, 0, 200)) == [0, 100, 200]
+    assert list(waveforms.square(4, 10, 20)) == [20, 20, 10, 10]
+    assert list(waveforms.square(4, 10, 20, duty=0.25)) == [20, 10, 10, 10]
+    assert list(waveforms.gamma(3, 0, 1.0, gamma=2)) == [0, 63, 255]
+    ease = waveforms.exponential(10)
+    assert ease[0] == 0 and ease[-1] == 255
+    assert all(np.diff(ease.astype(int)) >= 0)
+
+
+def test_adsr():
+    env = waveforms.adsr(2, 2, 3, 2, sustain_level=0.5, val_max=200)
+    assert list(env) == [0, 100, 200, 150, 100, 100, 100, 100, 0]
+
+
+def test_crossfade():
+    fade = waveforms.crossfade([0] * 5, [200] * 5)
+    assert list(fade) == [0, 50, 100, 150, 200]
+    assert waveforms.crossfade(b'\x00\x10', bytes(2)).tolist() == [0, 0]
+
+
+def test_memoized_and_read_only():
+    waveforms.cache_clear()
+    frames = waveforms.sine(64, 0.1, 0.9)
+    assert waveforms.sine(64, 0.1, 0.9) is frames
+    assert waveforms.sine.cache_info().hits == 1
+    assert frames.dtype == np.uint8
+    with pytest.raises(ValueError):
+        frames[0] = 1
+
+
+def test_memoized_int_and_float_ranges():
+    waveforms.cache_clear()
+    assert waveforms.sine(8, 0, 1).max() == 1
+    assert waveforms.sine(8, 0, 1.0).max() == 255
+    assert waveforms.sine(8, 0.0, 1).max() == 1